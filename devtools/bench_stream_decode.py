@@ -0,0 +1,86 @@
+"""Peak memory of buffered vs. streamed decoding of a webui image response.
+
+Simulates a txt2img response with 9 images of 1024x1024 (about 1.6 MB of
+PNG each, plus the grid) and measures the peak of memory allocated by Python
+while turning it into raw image bytes, once the old way (read the whole
+body, json.loads, prefix and decode every string) and once with
+elrond_image.ImageStreamDecoder fed 64 KB chunks. Uses tracemalloc, so it
+runs on Windows as well as on Linux.
+
+Run from the repository root:
+    python devtools/bench_stream_decode.py
+"""
+import base64
+import json
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+IMAGE_COUNT = 10  # 9 images plus the grid in front
+IMAGE_SIZE = 1600 * 1024
+CHUNK_SIZE = 65536
+
+
+def image_bytes(index: int) -> bytes:
+    return random.Random(index).randbytes(IMAGE_SIZE)
+
+
+def body_chunks():
+    """Yields the response body piece by piece, like a socket would."""
+    yield b'{"images": ['
+    for i in range(IMAGE_COUNT):
+        if i:
+            yield b", "
+        yield b'"'
+        data = image_bytes(i)
+        # 48 KB of raw data -> 64 KB of base64, keeps chunks aligned
+        for start in range(0, len(data), 49152):
+            yield base64.b64encode(data[start:start + 49152])
+        yield b'"'
+    yield b'], "parameters": {"prompt": "elrond"}, "info": '
+    yield json.dumps(json.dumps({"seed": 1})).encode()
+    yield b"}"
+
+
+def run_buffered() -> list[bytes]:
+    body = b"".join(body_chunks())
+    response_json = json.loads(body.decode("utf-8"))
+    encoded = ["data:image/png;base64," + img for img in response_json["images"]]
+    return [base64.b64decode(img[img.find(",") + 1:]) for img in encoded]
+
+
+def run_streamed() -> list[bytes]:
+    from elrond_image import ImageStreamDecoder
+
+    decoder = ImageStreamDecoder()
+    images = []
+    buffer = b""
+    for piece in body_chunks():
+        buffer += piece
+        while len(buffer) >= CHUNK_SIZE:
+            images += decoder.feed(buffer[:CHUNK_SIZE])
+            buffer = buffer[CHUNK_SIZE:]
+    images += decoder.feed(buffer)
+    return images
+
+
+def main() -> None:
+    decoded_mb = IMAGE_COUNT * IMAGE_SIZE / 1024 / 1024
+    print(f"{IMAGE_COUNT} images, {decoded_mb:.1f} MB of decoded image data")
+    for mode, run in [("buffered", run_buffered), ("streamed", run_streamed)]:
+        tracemalloc.start()
+        images = run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # Checked outside of the measurement, the comparison allocates too
+        assert len(images) == IMAGE_COUNT
+        assert all(images[i] == image_bytes(i) for i in range(IMAGE_COUNT))
+        del images
+        print(f"{mode:>9}: peak +{peak / 1024 / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import base64
+import contextlib
 import datetime
 import logging
 import asyncio
@@ -7,12 +8,13 @@ import io
 import random
 import time
 from random import randint
-import requests
 from dotenv import dotenv_values
 import interactions
 from interactions import Button, SelectMenu, SelectOption, spread_to_rows, autodefer
 import textwrap
 from  elrond_sd_interface import *
+from elrond_scheduler import batcher, scheduler
+from elrond_messages import MessageUpdater
 
 # load env variables
 config = dotenv_values('.env')
@@ -25,6 +27,20 @@ bot = interactions.Client(
 debug_mode=bool(config['DEBUG_MODE'] == "True")
 config_upscale_size=int(config['UPSCALE_SIZE']) # Set to 1 for no upscaling
 config_upscaler=str(config['UPSCALER'])
+# "postprocess" upscales finished images via the extras upscaler, "hires" lets txt2img render them big right away (hires fix)
+config_upscale_mode=str(config.get('UPSCALE_MODE') or "postprocess")
+config_hires_denoising_strength=float(config.get('HIRES_DENOISING_STRENGTH') or 0.5)
+# Seconds between two looks at the webui's progress while drawing, 0 turns it off
+config_progress_interval=float(config.get('PROGRESS_INTERVAL') or 0)
+# Seconds between two half finished previews shown while drawing, 0 turns them off. Costs GPU time and upload traffic
+config_progress_preview_interval=float(config.get('PROGRESS_PREVIEW_INTERVAL') or 0)
+# Draft mode first draws a quick and small version, the real picture follows when the GPU has time
+config_draft_steps=int(config.get('DRAFT_STEPS') or 8)
+config_draft_size=int(config.get('DRAFT_SIZE') or 256)
+# Load the models with a few tiny requests before the first user has to wait for it, and measure how long requests take
+config_warm_up=bool((config.get('WARM_UP') or "True") == "True")
+# Seconds between two checks whether the webui is still there, after a restart it gets warmed up again
+config_backend_check_interval=float(config.get('BACKEND_CHECK_INTERVAL') or 5)
 hive_active=bool(config['HIVEMIND'] == "True")
 log_usernames=bool(config['LOG_USERNAMES'] == "True")
 
@@ -36,19 +52,20 @@ if hive_active:
     bot.load("elrond_hive")
     hive = bot.get_extension("Hive")
 
+# Drawings still on their way, by message id. Cancel, Delete and deleting the message stop them
+running_drawings = {}
+
 # Using the discord file class, needed for the extension ext.files
-def base64_image_to_discord_image(encoded_image, filename):
-    # a base64 encoded string starting with "data:image/png;base64," prefix. Remove the prefix
-    z = encoded_image[encoded_image.find(',') + 1:]
-    
+def image_to_discord_file(image, filename):
+    # The image is a SdImage, its raw bytes are decoded only once and can be uploaded directly
     if debug_mode:
         with open(".debug.uploaded_discord_image.png", "wb") as fh:
-            fh.write(base64.b64decode(z))
+            fh.write(image.data)
     
     # Convert it into a discord file for later uploading them in bulk
     fxy = interactions.File(
         filename=filename,  
-        fp=base64.b64decode(z)
+        fp=image.data
         )
     return fxy
 
@@ -81,13 +98,15 @@ def escape_discord_markdown(content: str, max_len: int | None = None) -> str:
     return str(content)
 
 # Create a string like this: /draw prompt:Elrond sitting seed:123456789 quantity:2 negative_prompt:chair, bed
-def create_command_string(prompt, seed, quantity, negative_prompt, img2img_url, denoising_strength):
+def create_command_string(prompt, seed, quantity, negative_prompt, img2img_url, denoising_strength, checkpoint=""):
     command_string = "/draw prompt:" + prompt + " seed:" + str(seed) + " quantity:" + str(quantity)
     if negative_prompt:
         command_string = command_string + " negative_prompt:" + negative_prompt
     if img2img_url:
         command_string = command_string + " img2img_url:" + img2img_url
         command_string = command_string + " denoising_strength:" + str(denoising_strength)
+    if checkpoint:
+        command_string = command_string + " checkpoint:" + checkpoint
     return command_string
     
 # Parse an embed for the image generation data. Takes an discord message object to go through the embeds
@@ -98,6 +117,7 @@ def parse_embeds_in_message(message):
     negative_prompt = ""
     img2img_url = ""
     denoising_strength = 60
+    checkpoint = ""
     # Do we even have embeds here?
     if message.embeds:
         if len(message.embeds) > 0:
@@ -114,6 +134,8 @@ def parse_embeds_in_message(message):
                         # We display it as a percentage value, but in fact its a decimal. Later converted
                         elif field.name == "Denoising strength":
                             denoising_strength = int(field.value)
+                        elif field.name == "Checkpoint":
+                            checkpoint = field.value
                 # seed = The image footer.
                 if embed.footer:
                     if embed.footer.text:
@@ -142,7 +164,7 @@ def parse_embeds_in_message(message):
                         img2img_url = embed.thumbnail.proxy_url
                 # Only the first embed is useful for now. The other embeds dont contain any important information that cant be derived from the first embed.
                 break
-    return prompt, seed, quantity, negative_prompt, img2img_url, denoising_strength
+    return prompt, seed, quantity, negative_prompt, img2img_url, denoising_strength, checkpoint
     
 # Stupid little function that just takes a letter and makes it a color
 def assign_color_to_user(username):
@@ -170,17 +192,17 @@ def assign_color_to_user(username):
         color = interactions.Color.red()
         return color
 
-async def draw_image(ctx: interactions.CommandContext, prompt: str = "", seed: int = -1, quantity: int = 1, negative_prompt: str = "", img2img_url: str = "", denoising_strength = 60, host: str = None):
+async def draw_image(ctx: interactions.CommandContext, prompt: str = "", seed: int = -1, quantity: int = 1, negative_prompt: str = "", img2img_url: str = "", denoising_strength = 60, host: str = None, draft: bool = False, checkpoint: str = ""):
     if log_usernames:
         print("Request by " + ctx.user.username + "#" + ctx.user.discriminator)
     
      # If we are in img2img mode, first check if the given image can be downloaded
     img2img_mode = False
     if img2img_url != "":
-        img2img_image_data = await download_image_from_url(img2img_url)
+        img2img_image = await download_image_from_url(img2img_url)
         img2img_mode = True
         # Cancel if there is no image
-        if img2img_image_data == "":
+        if img2img_image is None:
             await ctx.send("No images found!", ephemeral=True)
             return
 
@@ -206,6 +228,7 @@ async def draw_image(ctx: interactions.CommandContext, prompt: str = "", seed: i
             pass
     
     # We need to know the seed for later use
+    random_seed = seed == -1
     if seed == -1:
         seed = random.randint(0, 999999999)
         
@@ -219,6 +242,9 @@ async def draw_image(ctx: interactions.CommandContext, prompt: str = "", seed: i
     # In image to image mode, we also have a denoising strength
     if img2img_mode:
         fields.append(interactions.EmbedField(name="Denoising strength",value=denoising_strength,inline=True))
+    # Only shown if the user picked a model, so "Try again!" picks the same one
+    if checkpoint:
+        fields.append(interactions.EmbedField(name="Checkpoint",value=checkpoint,inline=True))
     title = ""
     if img2img_mode:
         title = "Redrawing..." 
@@ -241,35 +267,171 @@ async def draw_image(ctx: interactions.CommandContext, prompt: str = "", seed: i
     b1 = Button(style=1, custom_id="same_prompt_again", label="Try again!")
     b2 = Button(style=3, custom_id="change_prompt", label="Edit")
     b3 = Button(style=2, custom_id="send_command_string", label="Copy")
-    # Delete needs a finished picture, add that option later
-    b4 = Button(style=4, custom_id="delete_picture", label="Delete (...)", disabled=True)
+    # Delete needs a finished picture, until then the same spot cancels the drawing
+    b4 = Button(style=4, custom_id="cancel_drawing", label="Cancel")
     components = spread_to_rows(b1, b2, b3, b4)#, s1)
     # Note: the maximum embed length of all fields combined is 6000 characters. We dont check that because we are lazy as fuck
     botmessage = await ctx.send(embeds=[main_embed], components=components)
+    # Progress edits only change text, the pictures are uploaded once at the very end
+    updater = MessageUpdater(botmessage)
+    # Cancelling the drawing cancels this task, and with it the GPU job it waits for
+    drawing_id = str(botmessage.id)
+    drawing_task = asyncio.current_task()
+    running_drawings[drawing_id] = {"task": drawing_task, "updater": updater, "draft": False}
+    drawing_task.add_done_callback(lambda _: running_drawings.pop(drawing_id, None))
+
+    # All GPU work goes through the job queue of the backend, everyone gets their turn
+    if host is None:
+        host = config["GRADIO_API_BASE_URL"]
+    user = str(ctx.user.id)
+    drawing_title = main_embed.title
+    generation_done = False
+    progress_task = None
+    async def show_queue_position(position):
+        # Tell the user where they are in the queue, until the picture is drawn
+        nonlocal progress_task
+        if generation_done:
+            return
+        if position > 0 and not scheduler.is_ready(host):
+            main_embed.title = drawing_title + f" (Stable Diffusion is warming up, position {position} in queue)"
+        elif position > 0:
+            main_embed.title = drawing_title + f" (waiting in queue, position {position}"
+            wait = scheduler.expected_wait(host, position)
+            if wait is not None:
+                main_embed.title += f", about {int(wait) + 1}s"
+            main_embed.title += ")"
+        else:
+            main_embed.title = drawing_title
+            # Our turn, from now on the webui's progress is ours
+            if config_progress_interval > 0 and progress_task is None:
+                progress_task = asyncio.create_task(show_progress())
+        await updater.progress([main_embed], components)
+
+    def gpu_queue(priority=0, cost=None):
+        # Only the webui call itself waits for a GPU slot. Cache hits and requests identical to one already on its way don't queue at all
+        return lambda call: scheduler.run(host, user, call, on_position=show_queue_position, priority=priority, cost=cost)
+
+    async def show_progress():
+        # Show step and remaining time, so nobody thinks the bot hangs and clicks "Try again!" once more
+        last_preview = time.monotonic()
+        while True:
+            await asyncio.sleep(config_progress_interval)
+            if generation_done or drawing_task.done():
+                return
+            want_preview = config_progress_preview_interval > 0 and time.monotonic() - last_preview >= config_progress_preview_interval
+            progress = await interface_progress(host, current_image=want_preview)
+            if generation_done:
+                return
+            if progress is None:
+                continue
+            state = progress.get("state") or {}
+            steps = state.get("sampling_steps") or 0
+            if steps <= 0 or not progress.get("progress"):
+                continue
+            status = f"{int(progress['progress'] * 100)}%, step {state.get('sampling_step', 0)} of {steps}"
+            if progress.get("eta_relative", 0) > 0:
+                status += f", about {int(progress['eta_relative']) + 1}s left"
+            main_embed.title = drawing_title + f" ({status})"
+            preview_files = None
+            if progress["current_image"] is not None:
+                last_preview = time.monotonic()
+                preview_files = [image_to_discord_file(image=progress["current_image"], filename="preview.png")]
+                main_embed.set_image(url="attachment://preview.png")
+            await updater.progress([main_embed], components, preview_files)
+
+    # In hires mode, txt2img renders single pictures big right away. Grids and prompt matrices stay small, they are big enough
+    hires_options = {}
+    if config_upscale_mode == "hires" and not img2img_mode and quantity < 4 and "|" not in prompt and config_upscale_size > 1:
+        hires_options = {
+            "hires_scale": config_upscale_size,
+            "hires_upscaler": config_upscaler or "Latent",
+            "hires_denoising_strength": config_hires_denoising_strength,
+            }
+
+    # The model to draw with. Only passed on if the user picked one, so requests without it can still share a batch with each other
+    model_options = {}
+    if checkpoint:
+        model_options["checkpoint"] = checkpoint
+        # Hive machines are picked by their loaded model, so they keep it. The shared webui switches back, otherwise one request would change the model for everyone
+        model_options["keep_checkpoint"] = host != config["GRADIO_API_BASE_URL"]
+
+    # Drafts only exist for text to image, redraws already have their composition
+    draft_mode = draft and not img2img_mode
 
     # Get data via web request. Image to image mode or text to image mode?
-    encoded_images = []
-    if img2img_mode:
-        encoded_images = await interface_img2img(prompt=prompt, seed=seed, quantity=quantity, negative_prompt=negative_prompt, img2img_image_data=img2img_image_data, denoising_strength=denoising_strength_decimal, host=host)
-    else:
-        encoded_images = await interface_txt2img(prompt=prompt, seed=seed, quantity=quantity, negative_prompt=negative_prompt, host=host)
+    images = []
+    backend_error = None
+    try:
+        # Don't queue up behind a backend that is known to be down
+        circuit_breaker.check(host)
+        if img2img_mode:
+            images = await interface_img2img(prompt=prompt, seed=seed, quantity=quantity, negative_prompt=negative_prompt, img2img_image=img2img_image, denoising_strength=denoising_strength_decimal, host=host, **model_options, queue=gpu_queue(cost=latency_stats.estimate(host, "/sdapi/v1/img2img", quantity)))
+        elif draft_mode:
+            # Few steps and a small size, same prompt and seed. Good enough to see where the picture is going
+            images = await interface_txt2img(prompt=prompt, seed=seed, quantity=quantity, negative_prompt=negative_prompt, host=host, steps=config_draft_steps, width=config_draft_size, height=config_draft_size, **model_options, queue=gpu_queue())
+        elif quantity == 1 and random_seed and "|" not in prompt:
+            # Single pictures with a random seed can share one GPU batch with other requests for the same prompt. The seed may change then
+            seed, images = await batcher.txt2img(host, user, prompt=prompt, seed=seed, negative_prompt=negative_prompt, on_position=show_queue_position, **hires_options, **model_options)
+            main_embed.footer = interactions.EmbedFooter(text=str(seed))
+        else:
+            images = await interface_txt2img(prompt=prompt, seed=seed, quantity=quantity, negative_prompt=negative_prompt, host=host, **hires_options, **model_options, queue=gpu_queue(cost=latency_stats.estimate(host, "/sdapi/v1/txt2img", quantity)))
+    except BackendUnavailableError as e:
+        backend_error = e
+    generation_done = True
+    if progress_task is not None:
+        progress_task.cancel()
+    main_embed.title = drawing_title
+
+    if draft_mode and len(images) > 0:
+        # Show the draft right away, the grid if there are several pictures. Delete and Edit work from now on
+        main_embed.title = textwrap.shorten("(Draft) " + prompt, width=60, placeholder="...")
+        main_embed.set_image(url="attachment://draft.png")
+        b4.custom_id = "delete_picture"
+        b4.label = "Delete"
+        components = spread_to_rows(b1, b2, b3, b4)
+        await updater.progress([main_embed], components, [image_to_discord_file(image=images[0], filename="draft.png")])
+        running_drawings[drawing_id]["draft"] = True
+        # The real picture waits until nobody else needs the GPU
+        drawing_title = main_embed.title
+        generation_done = False
+        progress_task = None
+        try:
+            images = await interface_txt2img(prompt=prompt, seed=seed, quantity=quantity, negative_prompt=negative_prompt, host=host, **hires_options, **model_options, queue=gpu_queue(priority=1, cost=latency_stats.estimate(host, "/sdapi/v1/txt2img", quantity)))
+        except BackendUnavailableError as e:
+            images = []
+            backend_error = e
+        generation_done = True
+        if progress_task is not None:
+            progress_task.cancel()
+        main_embed.title = drawing_title
     
     # No result?
-    if len(encoded_images) == 0:
+    if len(images) == 0:
         main_embed.title = "Drawing failed."
-        await botmessage.edit(embeds=[main_embed], components=components)
+        if backend_error is not None:
+            # Say why, so nobody keeps pressing "Try again!" right away
+            main_embed.title = "Drawing failed, Stable Diffusion is not reachable right now. Try again later."
+            main_embed.add_field(name="Error", value=escape_discord_markdown(str(backend_error), 1024))
+        # Also removes a preview, if there was one
+        main_embed.image = None
+        # Nothing left to cancel, the message can only be deleted now
+        b4.custom_id = "delete_picture"
+        b4.label = "Delete"
+        components = spread_to_rows(b1, b2, b3, b4)
+        # Stays cancellable until the edit is out, see cancel_drawing
+        await updater.finish([main_embed], components, [])
         return
 
     # If its multiple images, then the first one sent will be a grid of all other images combined
     multiple_images_as_one = False
-    if len(encoded_images) > 1:
+    if len(images) > 1:
         # User requested 4 or more images, ONLY send the comprehensive preview grid so the message doesnt bloat up
         if quantity >= 4 or "|" in prompt:
-            encoded_images = [encoded_images[0]]
+            images = [images[0]]
             multiple_images_as_one = True
         else:
             # Otherwise, skip the preview grid (first entry of this list)
-            encoded_images.pop(0)
+            images.pop(0)
 
     # Do we upscale later?
     upscale_later = True
@@ -279,22 +441,24 @@ async def draw_image(ctx: interactions.CommandContext, prompt: str = "", seed: i
     elif config_upscale_size <= 1:
         # Dont upscale, size 1 makes no sense
         upscale_later = False
+    elif hires_options:
+        # Dont upscale, the hires fix already made it big
+        upscale_later = False
   
-    # Prepare all images for discord, upload them, put them in embeds
+    # Prepare all images for discord and put them in embeds. They are uploaded with the final message
     files_to_upload = []
+    filenames = []
     embeds = [main_embed]
-    for i, encoded_image in enumerate(encoded_images):
+    for i, image in enumerate(images):
         # The seed given is just the starting seed for the first image, all other images have ongoing numbers
         current_seed = seed + i
 
         # Filename for upload.
         filename = str(current_seed) + ".png"
         
-        # Convert the base64 image to a discord file and save it in a list to upload later
-        files_to_upload.append(base64_image_to_discord_image(encoded_image=encoded_image, filename=filename))
-    
-        # Add the generated file to the latest embed
-        embeds[i].set_image(url="attachment://" + filename)
+        # Convert the image to a discord file and save it in a list to upload later
+        files_to_upload.append(image_to_discord_file(image=image, filename=filename))
+        filenames.append(filename)
 
         # Set the image title
         title = ""
@@ -302,15 +466,15 @@ async def draw_image(ctx: interactions.CommandContext, prompt: str = "", seed: i
             title += "(Preview) "
         if img2img_mode:
             title += "Redraw: "
-        if len(encoded_images) > 1:
-            title += f"[{i+1} of {len(encoded_images)}]: "
+        if len(images) > 1:
+            title += f"[{i+1} of {len(images)}]: "
         title += prompt
         title = textwrap.shorten(title, width=60, placeholder="...")
         # [0:256] is the maximum title length it looks stupid, make the title shorter
         embeds[i].title = title
 
         # If there are more pictures on the way, prepare the next embed with some filler text. Sub-embeds only need seed, thumbnail and timestamp.
-        if i+1 < len(encoded_images):
+        if i+1 < len(images):
             next_embed = interactions.Embed(
                             timestamp=datetime.datetime.utcnow(), 
                             color=assign_color_to_user(ctx.user.username),
@@ -320,34 +484,49 @@ async def draw_image(ctx: interactions.CommandContext, prompt: str = "", seed: i
                 next_embed.set_thumbnail(img2img_url)
             embeds.append(next_embed)
 
-    # Make the images bigger if neccessary
+    # Make the images bigger if neccessary. All images go to the upscaler together in one round trip
     if upscale_later:
-        for i, encoded_image in enumerate(encoded_images):
-            # Working message
-            embeds[i].title = f"Upscaling image {i+1} of {len(encoded_images)}..."
-            await botmessage.edit(embeds=embeds, files=files_to_upload, components=components)
-            # Call the upscaler
-            upscaler=config_upscaler
-            if not upscaler:
-                upscaler = "None"
-            upscaled_image = await interface_upscale_image(encoded_image=encoded_image, size=config_upscale_size, upscaler=upscaler) # a base64 encoded string starting with "data:image/png;base64," prefix
-            # Filename for upload.
-            current_seed = seed + i
-            filename = str(current_seed) + ".png"
-            # Replace the old and small image with the new and big image
-            files_to_upload[i] = base64_image_to_discord_image(encoded_image=upscaled_image, filename=filename)
+        # Working message
+        for i in range(len(images)):
+            embeds[i].title = f"Upscaling image {i+1} of {len(images)}..."
+        await updater.progress(embeds, components)
+        # Call the upscaler
+        upscaler=config_upscaler
+        if not upscaler:
+            upscaler = "None"
+        try:
+            # The drawing already had its turn, the upscale goes ahead of the queue instead of waiting a second full round
+            upscale_cost = latency_stats.estimate(config["GRADIO_API_BASE_URL"], "/sdapi/v1/extra-batch-images", len(images))
+            upscaled_images = await interface_upscale_images(images=images, size=config_upscale_size, upscaler=upscaler, queue=lambda call: scheduler.run(config["GRADIO_API_BASE_URL"], user, call, priority=-1, cost=upscale_cost))
+        except (BackendUnavailableError, OutOfMemoryError) as e:
+            # The small pictures are better than nothing
+            print("Upscaling failed: " + str(e))
+            upscale_error = "Upscaling failed, Stable Diffusion is not reachable right now: " + str(e)
+            upscaled_images = [None] * len(images)
+        else:
+            upscale_error = "Upscaling failed, this is the small version."
+        for i, upscaled_image in enumerate(upscaled_images):
+            # Replace the old and small image with the new and big image. If upscaling failed, keep the small one and say so
+            if upscaled_image is not None:
+                files_to_upload[i] = image_to_discord_file(image=upscaled_image, filename=filenames[i])
+            else:
+                embeds[i].add_field(name="Error", value=escape_discord_markdown(upscale_error, 1024))
             # Restore the image title
             title = ""
             if img2img_mode:
                 title += "Redraw: "
-            if len(encoded_images) > 1:
-                title += f"[{i+1} of {len(encoded_images)}]: "
+            if len(images) > 1:
+                title += f"[{i+1} of {len(images)}]: "
             title += prompt
             title = textwrap.shorten(title, width=60, placeholder="...")
             embeds[i].title = title
 
-    # Now enable the delete button and send the finished message
-    b4.disabled = False
+    # Add the generated files to their embeds, they are about to be uploaded
+    for i, filename in enumerate(filenames):
+        embeds[i].set_image(url="attachment://" + filename)
+
+    # Now enable the delete button and send the finished message. Too late to cancel
+    b4.custom_id = "delete_picture"
     b4.label = "Delete"
     #s1 = SelectMenu(
         #custom_id="s1",
@@ -357,11 +536,12 @@ async def draw_image(ctx: interactions.CommandContext, prompt: str = "", seed: i
         #],
     #)    
     components = spread_to_rows(b1, b2, b3, b4)#, s1)
-    await botmessage.edit(
+    # Stays cancellable until the edit is out, a Delete or Cancel meanwhile must not get the pictures back on the message
+    await updater.finish(
+        embeds,
+        components,
+        files_to_upload,
         content="",
-        embeds=embeds,
-        components=components,
-        files=files_to_upload,
         suppress_embeds=False, 
         )
         
@@ -417,12 +597,27 @@ async def draw_image(ctx: interactions.CommandContext, prompt: str = "", seed: i
             type=interactions.OptionType.STRING,
             required=False,
         ),        
+        interactions.Option(
+            name="draft",
+            description="Show a quick draft first, the real picture follows when the GPU has time",
+            type=interactions.OptionType.BOOLEAN,
+            required=False,
+        ),
+        interactions.Option(
+            name="checkpoint",
+            description="Model to draw with, as listed in the webui. Default is the loaded one",
+            type=interactions.OptionType.STRING,
+            min_length=0,
+            max_length=200,
+            required=False,
+        ),
     ],
 )
-async def draw(ctx: interactions.CommandContext, prompt: str = "", seed: int = -1, quantity: int = 1, negative_prompt: str = "", img2img_attachment: str = "", img2img_url: str = "", denoising_strength: int = 0):
+async def draw(ctx: interactions.CommandContext, prompt: str = "", seed: int = -1, quantity: int = 1, negative_prompt: str = "", img2img_attachment: str = "", img2img_url: str = "", denoising_strength: int = 0, draft: bool = False, checkpoint: str = ""):
     host = None
     if hive_active:
-        host = hive.get_random_client()
+        # Machines that already have the model loaded are preferred
+        host = await hive.pick_client(checkpoint)
     
     host_url = config["GRADIO_API_BASE_URL"] if host == None else host.url
 
@@ -430,23 +625,38 @@ async def draw(ctx: interactions.CommandContext, prompt: str = "", seed: int = -
     if img2img_attachment:
         if img2img_attachment.url:
             img2img_url = img2img_attachment.url
-    await draw_image(ctx=ctx, prompt=prompt, seed=seed, quantity=quantity, negative_prompt=negative_prompt, img2img_url=img2img_url, denoising_strength=denoising_strength, host=host_url)
+    # A hive machine counts this drawing as outstanding work until it's done
+    with hive.track(host) if hive_active else contextlib.nullcontext():
+        await draw_image(ctx=ctx, prompt=prompt, seed=seed, quantity=quantity, negative_prompt=negative_prompt, img2img_url=img2img_url, denoising_strength=denoising_strength, host=host_url, draft=draft, checkpoint=checkpoint)
     
+# Stop a drawing that is still on its way. Queued GPU jobs are dropped, running ones interrupted. Returns False if there was nothing to stop
+async def cancel_drawing(message_id, drafts_only=False):
+    drawing = running_drawings.get(str(message_id))
+    if drawing is None or (drafts_only and not drawing["draft"]):
+        return False
+    del running_drawings[str(message_id)]
+    drawing["task"].cancel()
+    # No more progress edits, whatever happens to the message next
+    await drawing["updater"].discard()
+    return True
+
 # Buttons for the pretty print 
 @bot.component("same_prompt_again")
 async def button_same_prompt_again(ctx):
     original_message = ctx.message
     # The generation data are hidden in the embedded object
-    prompt, seed, quantity, negative_prompt, img2img_url, denoising_strength = parse_embeds_in_message(original_message)
+    prompt, seed, quantity, negative_prompt, img2img_url, denoising_strength, checkpoint = parse_embeds_in_message(original_message)
     # Give a new seed
     new_seed = -1
-    await draw_image(ctx=ctx, prompt=prompt, seed=new_seed, quantity=quantity, negative_prompt=negative_prompt, img2img_url=img2img_url, denoising_strength=denoising_strength)
+    await draw_image(ctx=ctx, prompt=prompt, seed=new_seed, quantity=quantity, negative_prompt=negative_prompt, img2img_url=img2img_url, denoising_strength=denoising_strength, checkpoint=checkpoint)
     
 @bot.component("change_prompt")
 async def button_change_prompt(ctx):
     original_message = ctx.message
+    # Editing a draft means the final picture of the old prompt is not needed anymore
+    await cancel_drawing(original_message.id, drafts_only=True)
     # The generation data are hidden in the embedded object
-    prompt, seed, quantity, negative_prompt, img2img_url, denoising_strength = parse_embeds_in_message(original_message)
+    prompt, seed, quantity, negative_prompt, img2img_url, denoising_strength, checkpoint = parse_embeds_in_message(original_message)
     # Asking the user for a new prompt. Img2img mode or txt2img mode?
     modal = None
     if img2img_url == "":
@@ -574,15 +784,19 @@ async def modal_edit(ctx, new_prompt: str, new_negative_prompt: str, new_seed: s
         pass
     if quantity < 1 or quantity > 9:
         quantity = 1
+    # Keep the model of the original picture
+    checkpoint = ""
+    if original_message:
+        checkpoint = parse_embeds_in_message(original_message)[6]
     # Generate again
-    await draw_image(ctx=ctx, prompt=new_prompt, seed=seed, quantity=quantity, negative_prompt=new_negative_prompt)
+    await draw_image(ctx=ctx, prompt=new_prompt, seed=seed, quantity=quantity, negative_prompt=new_negative_prompt, checkpoint=checkpoint)
     
 @bot.component("send_command_string")
 async def button_send_command_string(ctx):
     original_message = ctx.message
     # Get the command string
-    prompt, seed, quantity, negative_prompt, img2img_url, denoising_strength = parse_embeds_in_message(original_message)
-    command_string = create_command_string(escape_discord_markdown(prompt), seed, quantity, escape_discord_markdown(negative_prompt), img2img_url, denoising_strength)
+    prompt, seed, quantity, negative_prompt, img2img_url, denoising_strength, checkpoint = parse_embeds_in_message(original_message)
+    command_string = create_command_string(escape_discord_markdown(prompt), seed, quantity, escape_discord_markdown(negative_prompt), img2img_url, denoising_strength, checkpoint)
     # Post it as private reply inside an embed for easy copying. Embeds have a copy feature on mobile
     content = None
     fields = []
@@ -635,9 +849,41 @@ async def button_delete_picture(ctx):
     else:
         # Add a "Restore" button in case the user changes its mind
         b3 = Button(style=2, custom_id="send_command_string", label="Restore")
+        # A draft's final picture shouldn't come back later
+        await cancel_drawing(original_message.id)
         # Replace the embeds by the new one which doesnt contain the picture. Also delete the pictures from the message attachments (discord server)
         await ctx.edit(files=[], attachments=[], embeds=new_embeds, components=[b3])
         return
+
+@bot.component("cancel_drawing")
+async def button_cancel_drawing(ctx):
+    original_message = ctx.message
+    # Only the author can cancel, same as deleting
+    current_user = ctx.user.username + "#" + ctx.user.discriminator
+    author = ""
+    for embed in original_message.embeds:
+        if embed.author and embed.author.name:
+            author = embed.author.name
+            break
+    if author != current_user:
+        await ctx.send("You can't cancel this drawing because it is not yours.", ephemeral=True)
+        return
+    if not await cancel_drawing(original_message.id):
+        await ctx.send("Nothing to cancel, the drawing is already finished.", ephemeral=True)
+        return
+    # Keep the prompt, so "Try again!", "Edit" and "Copy" still work. Previews are removed
+    embed = original_message.embeds[0]
+    embed.title = "Drawing cancelled"
+    embed.image = None
+    b1 = Button(style=1, custom_id="same_prompt_again", label="Try again!")
+    b2 = Button(style=3, custom_id="change_prompt", label="Edit")
+    b3 = Button(style=2, custom_id="send_command_string", label="Copy")
+    await ctx.edit(files=[], attachments=[], embeds=[embed], components=spread_to_rows(b1, b2, b3))
+
+@bot.event
+async def on_message_delete(message):
+    # Nobody will see the picture anymore, stop drawing it
+    await cancel_drawing(message.id)
     
 # Mode is either "tags" or "desc"
 async def get_images_from_message(ctx):
@@ -721,6 +967,7 @@ async def interrogate_image(ctx, mode):
     
     # For every found image we will generate one new tiny embed with thumbnail etc
     botmessage = await ctx.send(embeds=[interactions.Embed(title="Checking image...")])
+    updater = MessageUpdater(botmessage)
     output_embeds = []
         
     # Check all attachments and all embeds
@@ -735,9 +982,21 @@ async def interrogate_image(ctx, mode):
                             author=interactions.EmbedAuthor(name=ctx.user.username + "#" + ctx.user.discriminator),
                             provider=interactions.EmbedProvider(name="elrond, stable-diffusion, interrogate"),
                             )
-        await botmessage.edit(embeds=(output_embeds + [output_embed]))
+        # Still starting up? Then the job waits in the queue for a while
+        if not scheduler.is_ready(config["GRADIO_API_BASE_URL"]):
+            output_embed.title += " (Stable Diffusion is warming up)"
+        await updater.progress(output_embeds + [output_embed])
         # Call the interface service
-        description = await interface_interrogate_url(image_url, mode)
+        try:
+            # Download and cache lookup happen first, only the webui call waits in the GPU queue
+            interrogate_cost = latency_stats.estimate(config["GRADIO_API_BASE_URL"], "/sdapi/v1/interrogate")
+            description = await interface_interrogate_url(image_url, mode, queue=lambda call: scheduler.run(config["GRADIO_API_BASE_URL"], str(ctx.user.id), call, cost=interrogate_cost))
+        except BackendUnavailableError as e:
+            # No point in trying the other images
+            output_embed.title = "Stable Diffusion is not reachable right now. Try again later."
+            output_embed.description = escape_discord_markdown(str(e), 1024)
+            output_embeds.append(output_embed)
+            break
         if description:
             # Finalize the embed
             output_embed.title = None
@@ -746,6 +1005,7 @@ async def interrogate_image(ctx, mode):
             output_embeds.append(output_embed)
 
     # Delete original bot message and make a new one as reply
+    await updater.discard()
     await botmessage.delete("Temporary bot message deleted")
     if len(output_embeds) > 0:
         await ctx.target.reply(embeds=output_embeds)
@@ -780,6 +1040,7 @@ async def upscale_image(ctx):
     
     # For every found image we will generate one new tiny embed with thumbnail etc
     botmessage = await ctx.send(embeds=[interactions.Embed(title="Checking image...")])
+    updater = MessageUpdater(botmessage)
     output_embeds = []
     files_to_upload = []
         
@@ -800,24 +1061,46 @@ async def upscale_image(ctx):
                             author=interactions.EmbedAuthor(name=ctx.user.username + "#" + ctx.user.discriminator),
                             provider=interactions.EmbedProvider(name="elrond, stable-diffusion, upscale"),
                             )
-        await botmessage.edit(embeds=(output_embeds + [output_embed]),files=files_to_upload)
+        # Still starting up? Then the job waits in the queue for a while
+        if not scheduler.is_ready(config["GRADIO_API_BASE_URL"]):
+            output_embed.title += " (Stable Diffusion is warming up)"
+        # Only the text changes here, the upscaled files are uploaded once with the reply
+        await updater.progress(output_embeds + [output_embed])
         # Download the image
-        encoded_image = await download_image_from_url(image_url)
+        image = await download_image_from_url(image_url)
+        if image is None:
+            continue
         # Call the interface service, upscale it by factor two
-        upscaled_image = await interface_upscale_image(encoded_image, size=2, upscaler=upscaler)
+        try:
+            # A cached upscale comes back right away, only the webui call waits in the GPU queue
+            upscale_cost = latency_stats.estimate(config["GRADIO_API_BASE_URL"], "/sdapi/v1/extra-single-image")
+            upscaled_image = await interface_upscale_image(image, size=2, upscaler=upscaler, queue=lambda call: scheduler.run(config["GRADIO_API_BASE_URL"], str(ctx.user.id), call, cost=upscale_cost))
+        except BackendUnavailableError as e:
+            print("Upscaling failed: " + str(e))
+            error_embed = interactions.Embed(title="Stable Diffusion is not reachable right now. Try again later.", description=escape_discord_markdown(str(e), 1024))
+            await ctx.send(embeds=[error_embed], ephemeral=True)
+            break
+        if upscaled_image is None:
+            # The webui refused it, e.g. because the configured upscaler doesn't exist there
+            error_embed = interactions.Embed(title=f"Upscaling image {int(i+1)} of {len(image_urls)} failed.", description="Stable Diffusion could not upscale it with " + escape_discord_markdown(upscaler, 200) + ".")
+            await ctx.send(embeds=[error_embed], ephemeral=True)
+            continue
         # Filename for upload.
         filename = "upscaler_" + str(i) + ".png"
         # List of files to upload to the discord server
-        files_to_upload.append(base64_image_to_discord_image(encoded_image=upscaled_image, filename=filename))
-        # Show the image in the embed, and update embed title
+        files_to_upload.append(image_to_discord_file(image=upscaled_image, filename=filename))
+        # Update embed title. The image is shown once it is uploaded with the reply
         output_embed.title = f"Upscaled image {int(i+1)} of {len(image_urls)}"
-        output_embed.set_image(url="attachment://" + filename)
         output_embed.description = None
         output_embeds.append(output_embed)
 
     # Delete original bot message and make a new one as reply
+    await updater.discard()
     await botmessage.delete("Temporary bot message deleted")
     if len(output_embeds) > 0:
+        # Show the images in the embeds
+        for output_embed, file in zip(output_embeds, files_to_upload):
+            output_embed.set_image(url="attachment://" + file._filename)
         try: 
             await ctx.target.reply(embeds=output_embeds,files=files_to_upload)
         except interactions.api.error.LibraryException:
@@ -843,7 +1126,7 @@ async def redraw_image(ctx):
         return
     if len(img_urls) > 0:
         # It could be our own old message. In that case we have some metadata there.
-        prompt, seed, quantity, negative_prompt, img2img_url, denoising_strength = parse_embeds_in_message(ctx.target)
+        prompt, seed, quantity, negative_prompt, img2img_url, denoising_strength, checkpoint = parse_embeds_in_message(ctx.target)
         if seed == -1:
             seed = 0
         # Now iterate all images found before. Dont use the img2img_url from the embed, because there wont always be an embed when right-clicking on random images.
@@ -930,24 +1213,51 @@ async def modal_redraw(ctx, new_prompt: str, new_negative_prompt: str, new_seed:
     # Denoising strength = How different the image can be. 1.0 would be completely unrelated, 0.0 would be the same image as before.
     await draw_image(ctx=ctx, prompt=new_prompt, seed=seed, quantity=1, negative_prompt=new_negative_prompt, img2img_url=new_image_url, denoising_strength=denoising_strength)
 
+# Runs in the background, the bot answers commands in the meantime and queues up their GPU jobs
+async def wait_for_backend():
+    host = config["GRADIO_API_BASE_URL"]
+    while True:
+        print("Waiting for webui " + str(host) + " to start...")
+        await wait_for_webui(host)
+        while circuit_breaker.is_open(host):
+            # It answers but keeps failing real requests, wait until the breaker lets them through again
+            await asyncio.sleep(config_backend_check_interval)
+        if config_warm_up:
+            print("Webui " + str(host) + " answers, warming up...")
+            try:
+                await interface_warm_up(host, upscaler=config_upscaler or "None")
+            except Exception as e:
+                # Cold but usable, the first users just have to wait a bit longer
+                print("Warm-up of " + str(host) + " failed: " + str(e))
+        if circuit_breaker.is_open(host):
+            # The warm-up kept failing, start over
+            continue
+        print("Webui " + str(host) + " is ready!")
+        scheduler.set_ready(host, True)
+
+        # Keep an eye on it. A restarted webui has to load its models again, hold the jobs back until it is warm
+        while not circuit_breaker.is_open(host) and await interface_progress(host) is not None:
+            await asyncio.sleep(config_backend_check_interval)
+        print("Webui " + str(host) + " went away, holding back jobs")
+        scheduler.set_ready(host, False)
+
 @bot.event
 async def on_start():
     print("Bot is running!")
+    asyncio.create_task(wait_for_backend())
 
 
 if hive_active:
     print("Elrond Hivemode active, try reaching hives...")    
 
-print("Waiting for webui " + str(config["GRADIO_API_BASE_URL"]) + " to start...", end="")
-while True:
-    try:
-        requests.get(config["GRADIO_API_BASE_URL"])
-        break
-    except:
-        print(".", end="")
-        time.sleep(5)
+# Hold back GPU jobs until the webui answers, see wait_for_backend
+scheduler.set_ready(config["GRADIO_API_BASE_URL"], False)
 
 # local methods are only available to the extension class once passed via the client instance
 bot.draw = draw_image
-bot.start()
+try:
+    bot.start()
+finally:
+    # Close the pooled webui/CDN connections on shutdown
+    bot._loop.run_until_complete(session_pool.close())
 
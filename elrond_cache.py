@@ -0,0 +1,379 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from typing import Any
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+from elrond_image import SdImage
+
+# Query parameters Discord adds to signed CDN links. They change every time a
+# link is refreshed but don't change the file behind it.
+discord_signature_params = ["ex", "is", "hm"]
+# Hosts that sign their links that way. Elsewhere these parameters may well
+# pick a different file
+discord_cdn_hosts = ["cdn.discordapp.com", "media.discordapp.net"]
+
+
+def normalize_url(url: str) -> str:
+    """Returns a canonical form of an image URL for cache lookups.
+
+    Scheme and host are lowercased and the query is sorted. For Discord CDN
+    links the signature parameters are dropped too, so the same attachment
+    always maps to the same key no matter which message or refresh the link
+    came from.
+
+    Args:
+        url: The image URL.
+
+    Returns:
+        The normalized URL.
+    """
+
+    parsed = urlparse(url)
+    signed = (parsed.hostname or "").lower() in discord_cdn_hosts
+    query = sorted((key, value) for key, value in parse_qsl(parsed.query)
+                   if not (signed and key in discord_signature_params))
+    return urlunparse((parsed.scheme.lower(), parsed.netloc.lower(),
+                       parsed.path, "", urlencode(query), ""))
+
+
+def discord_link_expiry(url: str) -> float | None:
+    """Returns the unix time a signed Discord CDN link expires, if any."""
+    parsed = urlparse(url)
+    if (parsed.hostname or "").lower() not in discord_cdn_hosts:
+        return None
+    for key, value in parse_qsl(parsed.query):
+        if key == "ex":
+            try:
+                return float(int(value, 16))
+            except ValueError:
+                return None
+    return None
+
+
+class DownloadCache():
+    """Byte-bounded LRU cache for downloaded source images.
+
+    Entries are looked up by normalized URL and stored by content hash, so
+    several URLs pointing to the same file (e.g. an attachment reposted as
+    an embed thumbnail) share one copy. Entries expire after `ttl` seconds
+    or when their signed Discord link expires, whichever comes first. Least
+    recently used URLs are dropped once the stored images exceed
+    `max_bytes`.
+    """
+
+    max_bytes: int
+    ttl: float
+    size: int
+    hits: int
+    misses: int
+
+    def __init__(self, max_bytes: int, ttl: float) -> None:
+        """Constructor method.
+
+        Args:
+            max_bytes: Byte budget for all cached images, 0 disables the cache.
+            ttl: Seconds after which an entry is downloaded again.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # normalized URL -> (content hash, monotonic expiry time)
+        self._urls: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        # content hash -> image and the number of URLs referencing it
+        self._images: dict[str, SdImage] = {}
+        self._refs: dict[str, int] = {}
+
+    def get(self, url: str) -> SdImage | None:
+        """Returns the cached image for the URL, or None on a miss."""
+        key = normalize_url(url)
+        entry = self._urls.get(key)
+        if entry is not None and entry[1] <= time.monotonic():
+            self._drop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._urls.move_to_end(key)
+        self.hits += 1
+        return self._images[entry[0]]
+
+    def put(self, url: str, image: SdImage) -> None:
+        """Stores a freshly downloaded image under the URL."""
+        if len(image) > self.max_bytes:
+            return
+        key = normalize_url(url)
+        if key in self._urls:
+            self._drop(key)
+
+        lifetime = self.ttl
+        link_expiry = discord_link_expiry(url)
+        if link_expiry is not None:
+            lifetime = min(lifetime, link_expiry - time.time())
+        if lifetime <= 0:
+            return
+
+        digest = image.sha256
+        if digest not in self._images:
+            self._images[digest] = image
+            self._refs[digest] = 0
+            self.size += len(image)
+        self._refs[digest] += 1
+        self._urls[key] = (digest, time.monotonic() + lifetime)
+
+        while self.size > self.max_bytes and self._urls:
+            self._drop(next(iter(self._urls)))
+
+    def _drop(self, key: str) -> None:
+        digest, _ = self._urls.pop(key)
+        self._refs[digest] -= 1
+        if self._refs[digest] == 0:
+            del self._refs[digest]
+            self.size -= len(self._images.pop(digest))
+
+
+class InterrogationCache():
+    """Caches interrogation captions by image content and model.
+
+    Keys are (sha256 of the image bytes, model), so the same picture gets
+    the same caption no matter where it was posted. The most recently used
+    `max_entries` captions are kept in memory. If a database path is given,
+    every caption is also written to SQLite and looked up there on a memory
+    miss, so the cache survives restarts.
+    """
+
+    max_entries: int
+    hits: int
+    misses: int
+
+    def __init__(self, max_entries: int, db_path: str | None = None) -> None:
+        """Constructor method.
+
+        Args:
+            max_entries: How many captions to keep in memory.
+            db_path: Optional SQLite file to spill captions to.
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._captions: OrderedDict[tuple[str, str], str] = OrderedDict()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path)
+            self._db.execute("CREATE TABLE IF NOT EXISTS interrogations ("
+                             "sha256 TEXT NOT NULL, model TEXT NOT NULL, "
+                             "caption TEXT NOT NULL, "
+                             "PRIMARY KEY (sha256, model))")
+            self._db.commit()
+
+    def get(self, digest: str, model: str) -> str | None:
+        """Returns the cached caption, or None on a miss."""
+        key = (digest, model)
+        caption = self._captions.get(key)
+        if caption is not None:
+            self._captions.move_to_end(key)
+        elif self._db is not None:
+            row = self._db.execute("SELECT caption FROM interrogations "
+                                   "WHERE sha256 = ? AND model = ?",
+                                   key).fetchone()
+            if row is not None:
+                caption = row[0]
+                self._remember(key, caption)
+        if caption is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return caption
+
+    def put(self, digest: str, model: str, caption: str) -> None:
+        """Stores the caption of a finished interrogation."""
+        self._remember((digest, model), caption)
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO interrogations "
+                             "(sha256, model, caption) VALUES (?, ?, ?)",
+                             (digest, model, caption))
+            self._db.commit()
+
+    def _remember(self, key: tuple[str, str], caption: str) -> None:
+        self._captions[key] = caption
+        self._captions.move_to_end(key)
+        while len(self._captions) > self.max_entries:
+            self._captions.popitem(last=False)
+
+
+class UpscaleCache():
+    """Content-addressed on-disk store for upscaled images.
+
+    Every upscale result is written to `directory` under a name derived from
+    (sha256 of the input image, size factor, upscaler). A repeated request
+    is answered from disk without touching the GPU. Files are read in one
+    go and closed right away, a file kept open or mapped couldn't be
+    replaced or deleted on Windows. Least recently used files are deleted
+    once the store grows over `max_bytes`. A store that can't be written
+    (disk full, no permission) just doesn't cache.
+    """
+
+    directory: str
+    max_bytes: int
+    size: int
+    hits: int
+    misses: int
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        """Constructor method, picks up files left by earlier runs.
+
+        Args:
+            directory: Where to keep the files, created if missing.
+            max_bytes: Byte budget for the whole store, 0 disables it.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # file name -> size, least recently used first
+        self._files: OrderedDict[str, int] = OrderedDict()
+        if max_bytes <= 0:
+            return
+        os.makedirs(directory, exist_ok=True)
+        existing = []
+        for entry in os.scandir(directory):
+            if entry.is_file() and entry.name.endswith(".png"):
+                stat = entry.stat()
+                existing.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, file_size in sorted(existing):
+            self._files[name] = file_size
+            self.size += file_size
+        self._evict()
+
+    @staticmethod
+    def _name(digest: str, size: int, upscaler: str) -> str:
+        key = digest + ":" + str(size) + ":" + upscaler
+        return hashlib.sha256(key.encode("utf-8")).hexdigest() + ".png"
+
+    def get(self, digest: str, size: int, upscaler: str) -> SdImage | None:
+        """Returns the stored upscale of the given input, or None on a miss.
+
+        Args:
+            digest: sha256 of the input image.
+            size: The upscaling factor.
+            upscaler: The upscaler name.
+        """
+        name = self._name(digest, size, upscaler)
+        if name not in self._files:
+            self.misses += 1
+            return None
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            data = b""
+        if not data:
+            # Deleted behind our back or empty
+            self.size -= self._files.pop(name)
+            self.misses += 1
+            return None
+        self._files.move_to_end(name)
+        self.hits += 1
+        return SdImage.from_bytes(data)
+
+    def put(self, digest: str, size: int, upscaler: str,
+            image: SdImage) -> None:
+        """Stores an upscale result.
+
+        Args:
+            digest: sha256 of the input image.
+            size: The upscaling factor.
+            upscaler: The upscaler name.
+            image: The upscaled image.
+        """
+        if self.max_bytes <= 0 or len(image) > self.max_bytes:
+            return
+        name = self._name(digest, size, upscaler)
+        path = os.path.join(self.directory, name)
+        # Write to a temporary file first so readers never see half a file
+        try:
+            with open(path + ".tmp", "wb") as f:
+                f.write(image.data)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print("Upscale cache write failed: " + str(e))
+            try:
+                os.remove(path + ".tmp")
+            except OSError:
+                pass
+            return
+        if name in self._files:
+            self.size -= self._files.pop(name)
+        self._files[name] = len(image)
+        self.size += len(image)
+        self._evict()
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes and self._files:
+            name, file_size = self._files.popitem(last=False)
+            self.size -= file_size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+class SingleFlight():
+    """Shares one in-flight call between identical concurrent requests.
+
+    The first caller for a key starts the call, everyone arriving with the
+    same key while it runs waits for that same result (or exception). Once
+    the call finishes the key is forgotten, later callers start a new call.
+    A waiter that gets cancelled does not cancel the shared call for the
+    others, only when the last waiter is gone the call is cancelled too.
+    """
+
+    def __init__(self) -> None:
+        """Constructor method."""
+        self._calls: dict[str, asyncio.Future] = {}
+        self._waiters: dict[asyncio.Future, int] = {}
+
+    async def do(self, key: str,
+                 call: Callable[[], Awaitable[Any]]) -> Any:
+        """Runs call() once for all concurrent callers with the same key.
+
+        Args:
+            key: Identifies the request, see elrond_sd_interface.request_key.
+            call: Starts the actual request, only invoked for the first caller.
+
+        Returns:
+            The result of the shared call.
+        """
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(call())
+            self._calls[key] = future
+            self._waiters[future] = 0
+            future.add_done_callback(lambda _: self._forget(key, future))
+        self._waiters[future] += 1
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.done() and self._waiters[future] == 1:
+                # Nobody else wants the result anymore, and nobody new
+                # should join a call that is being cancelled
+                self._forget(key, future)
+                future.cancel()
+            raise
+        finally:
+            self._waiters[future] -= 1
+            if self._waiters[future] == 0:
+                del self._waiters[future]
+
+    def _forget(self, key: str, future: asyncio.Future) -> None:
+        if self._calls.get(key) is future:
+            del self._calls[key]
@@ -1,20 +1,49 @@
+import asyncio
+import contextlib
+import json
 import random
+import sqlite3
+import time
+from collections.abc import Iterator
+from typing import Any
 from datetime import datetime, timedelta, timezone
 from urllib.error import URLError
 from urllib.parse import urlparse
 
+import aiohttp
 import interactions
-import requests
-from urllib3.exceptions import HTTPError
+from dotenv import dotenv_values
+
+from elrond_sd_interface import (circuit_breaker, client_timeout,
+                                 interface_progress, latency_stats,
+                                 session_pool, status_timeout)
+
+config = dotenv_values(".env")
+# How the next hive node is picked: random, least_outstanding, ewma or p2c
+hive_routing = config.get("HIVE_ROUTING") or "p2c"
+# Seconds a node's queue state is trusted before asking it again
+hive_queue_refresh = float(config.get("HIVE_QUEUE_REFRESH") or 5)
+# Seconds to wait for a node's queue state while routing, slow nodes count as unknown
+hive_queue_timeout = float(config.get("HIVE_QUEUE_TIMEOUT") or 1)
+# Seconds between two health checks of every node
+hive_probe_interval = float(config.get("HIVE_PROBE_INTERVAL") or 30)
+# Failed checks in a row until a node gets no more requests
+hive_unhealthy_after = int(config.get("HIVE_UNHEALTHY_AFTER") or 3)
+# Failed checks in a row until a node is dropped from the hive
+hive_evict_after = int(config.get("HIVE_EVICT_AFTER") or 10)
+# Hours until a node is dropped anyway, gradio share links expire after 72 hours
+hive_node_ttl = float(config.get("HIVE_NODE_TTL") or 72)
+hive_db = config.get("HIVE_DB") or None # Empty forgets all machines on restart
 
 
 # custom Exception classes for more fine-grained error handling
 class VersionNotSupportedError(Exception):
-    pass
+    def __init__(self, foundver: str = None) -> None:
+        self.foundver = foundver
 
 
 class NoSdWebUiError(Exception):
-    def __init__(self, foundver: str) -> None:
+    def __init__(self, foundver: str = None) -> None:
         self.foundver = foundver
 
 
@@ -30,6 +59,10 @@ class HiveBot():
     nickname: str
     config: dict
     dt_added: datetime
+    in_flight: int
+    queue_depth: int
+    queue_checked: float
+    failures: int
 
     def __init__(self, url: str, access_token: str = None, nickname: str = None,
                  config: dict = None) -> None:
@@ -48,6 +81,255 @@ class HiveBot():
         # datetime of this machine's registration to the hivemind, primarily used for
         # time-based invalidation/deregistration
         self.dt_added = datetime.now(tz=timezone(timedelta(hours=1)))
+        # requests routed to this machine that haven't finished yet
+        self.in_flight = 0
+        # jobs the machine's webui still has to work through, as it last
+        # reported it, and when that was (monotonic time)
+        self.queue_depth = 0
+        self.queue_checked = 0.0
+        # failed health checks in a row
+        self.failures = 0
+
+    @property
+    def latency(self) -> float | None:
+        """Moving average of the seconds per picture, None if unknown."""
+        return latency_stats.estimate(self.url, "/sdapi/v1/txt2img")
+
+    @property
+    def load(self) -> int:
+        """Outstanding work: our own requests plus the webui's queue."""
+        return self.in_flight + self.queue_depth
+
+    @property
+    def healthy(self) -> bool:
+        """False while the machine failed too many checks or requests."""
+        return (self.failures < hive_unhealthy_after and
+                not circuit_breaker.is_open(self.url))
+
+    @property
+    def expired(self) -> bool:
+        """True once the machine's share link is too old to still work."""
+        age = datetime.now(tz=self.dt_added.tzinfo) - self.dt_added
+        return age >= timedelta(hours=hive_node_ttl)
+
+    def has_checkpoint(self, checkpoint: str) -> bool:
+        """True if the machine has the model loaded, as far as we know.
+
+        The model is given by its title ("model.safetensors [hash]") or
+        its model name as /sdapi/v1/sd-models lists them.
+        """
+        config = self.config or {}
+        wanted = checkpoint.lower()
+        return any(name and name.lower() == wanted
+                   for name in [config.get("checkpoint"),
+                                config.get("checkpoint_name")])
+
+    def set_checkpoint(self, checkpoint: str) -> None:
+        """Remembers the model the machine was told to load."""
+        if self.config is None:
+            self.config = {}
+        self.config["checkpoint"] = checkpoint
+        self.config["checkpoint_name"] = None
+
+    async def refresh_checkpoint(self) -> None:
+        """Asks the machine's webui which model it has loaded right now.
+
+        The gradio /config scraped at registration only tells the model the
+        UI started with, requests that switch models don't show up there.
+        """
+        options = await self._get_json("/sdapi/v1/options")
+        if not options or not options.get("sd_model_checkpoint"):
+            return
+        title = options["sd_model_checkpoint"]
+        config = self.config or {}
+        if title != config.get("checkpoint") or not config.get("checkpoint_name"):
+            # Users ask for the short model name, look it up once per switch
+            models = await self._get_json("/sdapi/v1/sd-models") or []
+            config["checkpoint_name"] = next(
+                (model.get("model_name") for model in models
+                 if model.get("title") == title), None)
+        config["checkpoint"] = title
+        self.config = config
+
+    async def _get_json(self, path: str) -> Any:
+        session = session_pool.get(self.url)
+        try:
+            async with session.get(self.url + path,
+                                   timeout=client_timeout(status_timeout)) as resp:
+                if resp.status != 200:
+                    return None
+                return await resp.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            return None
+
+    async def probe(self, count_failures: bool = True) -> bool:
+        """Checks the machine is alive and asks how much work it has left.
+
+        Args:
+            count_failures: Whether the outcome counts towards the machine's
+                health. Only the regular checks should, a quick look before
+                routing a request may well be cut short.
+
+        Returns:
+            False if the machine didn't answer.
+        """
+        progress = await interface_progress(self.url)
+        if progress is None:
+            if count_failures:
+                self.failures += 1
+            return False
+        if count_failures:
+            self.failures = 0
+        state = progress.get("state") or {}
+        if state.get("job"):
+            self.queue_depth = max(1, (state.get("job_count") or 0) -
+                                   (state.get("job_no") or 0))
+        else:
+            self.queue_depth = 0
+        self.queue_checked = time.monotonic()
+        return True
+
+
+class HiveRouter():
+    """Picks the hive machine for the next request.
+
+    Policies:
+        random: Any machine, the old behaviour.
+        least_outstanding: The machine with the least outstanding work.
+        ewma: The machine expected to finish the request first, judged by
+            its outstanding work times its average seconds per picture.
+        p2c: Power of two choices, the better of two random machines by
+            the ewma measure. Nearly as good as looking at every machine,
+            and several bots can't all pile onto the same "best" one.
+
+    Machines without latency measurements count as fast as the fastest
+    known one, so they get work and with it measurements.
+
+    If a request wants a certain checkpoint, machines that have it loaded
+    come first, see prefer_checkpoint.
+    """
+
+    policies = ["random", "least_outstanding", "ewma", "p2c"]
+    policy: str
+
+    def __init__(self, policy: str = "p2c") -> None:
+        """Constructor method.
+
+        Args:
+            policy: One of HiveRouter.policies.
+
+        Raises:
+            ValueError: The policy is unknown.
+        """
+        if policy not in self.policies:
+            raise ValueError("Unknown hive routing policy " + policy +
+                             ", use one of " + ", ".join(self.policies))
+        self.policy = policy
+
+    def choose(self, hivebots: list[HiveBot],
+               checkpoint: str | None = None) -> HiveBot | None:
+        """Returns the machine to send the next request to, None if empty.
+
+        Args:
+            hivebots: The machines to choose from.
+            checkpoint: The model the request wants, if any.
+        """
+        if not hivebots:
+            return None
+        if checkpoint:
+            hivebots = self.prefer_checkpoint(hivebots, checkpoint)
+        if self.policy == "random":
+            return random.choice(hivebots)
+        if self.policy == "least_outstanding":
+            return min(random.sample(hivebots, len(hivebots)),
+                       key=lambda hivebot: hivebot.load)
+        if self.policy == "p2c" and len(hivebots) > 2:
+            hivebots = random.sample(hivebots, 2)
+        known = [hivebot.latency for hivebot in hivebots
+                 if hivebot.latency is not None]
+        default_latency = min(known) if known else 1.0
+
+        def expected_finish(hivebot: HiveBot) -> float:
+            latency = hivebot.latency
+            if latency is None:
+                latency = default_latency
+            return (hivebot.load + 1) * latency
+
+        return min(random.sample(hivebots, len(hivebots)), key=expected_finish)
+
+    @staticmethod
+    def prefer_checkpoint(hivebots: list[HiveBot],
+                          checkpoint: str) -> list[HiveBot]:
+        """Narrows the choice down to machines that have the model loaded.
+
+        Loading another model takes several seconds, so a machine that has
+        to swap only comes into question while all machines with the model
+        are busy and it is idle. If no machine has the model, any will do.
+        """
+        loaded = [hivebot for hivebot in hivebots
+                  if hivebot.has_checkpoint(checkpoint)]
+        if not loaded or any(hivebot.load == 0 for hivebot in loaded):
+            return loaded or hivebots
+        idle = [hivebot for hivebot in hivebots if hivebot.load == 0]
+        return idle or loaded
+
+
+class HiveRegistry():
+    """Keeps the hive machines in a SQLite file across bot restarts.
+
+    Stores everything needed to talk to a machine again (URL, nickname,
+    access token, the scraped config) plus its registration time, failed
+    checks and latency. Access tokens are stored as they are, keep the
+    file private.
+    """
+
+    def __init__(self, db_path: str) -> None:
+        """Constructor method.
+
+        Args:
+            db_path: The SQLite file, created if missing.
+        """
+        self._db = sqlite3.connect(db_path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS hivebots ("
+                         "url TEXT PRIMARY KEY, nickname TEXT, "
+                         "access_token TEXT, botconfig TEXT NOT NULL, "
+                         "dt_added TEXT NOT NULL, failures INTEGER NOT NULL, "
+                         "latency REAL)")
+        self._db.commit()
+
+    def load(self) -> list[HiveBot]:
+        """Returns the stored machines, their latency goes to latency_stats.
+
+        They count as unhealthy until they answer a check again.
+        """
+        hivebots = []
+        for (url, nickname, access_token, botconfig, dt_added, failures,
+             latency) in self._db.execute("SELECT url, nickname, access_token, "
+                                          "botconfig, dt_added, failures, "
+                                          "latency FROM hivebots"):
+            hivebot = HiveBot(url, access_token, nickname, json.loads(botconfig))
+            hivebot.dt_added = datetime.fromisoformat(dt_added)
+            hivebot.failures = max(failures, hive_unhealthy_after)
+            if latency is not None:
+                latency_stats.record(url, "/sdapi/v1/txt2img", latency)
+            hivebots.append(hivebot)
+        return hivebots
+
+    def save(self, hivebots: list[HiveBot]) -> None:
+        """Stores or updates the machines."""
+        self._db.executemany(
+            "INSERT OR REPLACE INTO hivebots (url, nickname, access_token, "
+            "botconfig, dt_added, failures, latency) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(hivebot.url, hivebot.nickname, hivebot.access_token,
+              json.dumps(hivebot.config or {}), hivebot.dt_added.isoformat(),
+              hivebot.failures, hivebot.latency) for hivebot in hivebots])
+        self._db.commit()
+
+    def remove(self, url: str) -> None:
+        """Forgets a machine."""
+        self._db.execute("DELETE FROM hivebots WHERE url = ?", (url,))
+        self._db.commit()
 
 
 # Discord interactions extension class
@@ -58,12 +340,117 @@ class Hive(interactions.Extension):
     def __init__(self, client: interactions.Client) -> None:
         self.bot = client
         self.hivebots = []
-
-    def get_random_client(self) -> HiveBot | None:
+        self.router = HiveRouter(hive_routing)
+        self.registry = None
+        if hive_db:
+            # Checked again right after the start, see probe_loop
+            self.registry = HiveRegistry(hive_db)
+            for hivebot in self.registry.load():
+                if hivebot.expired:
+                    self.registry.remove(hivebot.url)
+                else:
+                    self.hivebots.append(hivebot)
+            if self.hivebots:
+                print("Restored " + str(len(self.hivebots)) + " hive machines")
+
+    async def pick_client(self, checkpoint: str | None = None) -> HiveBot | None:
+        """Returns the machine the routing policy picks, None if there is none.
+
+        Args:
+            checkpoint: The model the request wants, if any.
+        """
+        if self.router.policy != "random":
+            # Ask the machines with outdated queue state all at once, but
+            # don't let a slow one hold up the request. Whoever doesn't answer
+            # in time keeps its last known queue depth, slow isn't unhealthy
+            stale = [hivebot for hivebot in self.available_clients()
+                     if time.monotonic() - hivebot.queue_checked >= hive_queue_refresh]
+            if stale:
+                await asyncio.wait([asyncio.create_task(hivebot.probe(count_failures=False))
+                                    for hivebot in stale],
+                                   timeout=hive_queue_timeout)
+        hivebot = self.router.choose(self.available_clients(), checkpoint)
+        if hivebot is not None and checkpoint and not hivebot.has_checkpoint(checkpoint):
+            # The request makes it switch and the model stays loaded. The
+            # next check tells the real model name
+            hivebot.set_checkpoint(checkpoint)
+        return hivebot
+
+    def available_clients(self) -> list[HiveBot]:
+        """Returns the machines that may get requests right now."""
+        return [hivebot for hivebot in self.hivebots
+                if hivebot.healthy and not hivebot.expired]
+
+    @interactions.extension_listener(name="on_start")
+    async def start_prober(self) -> None:
+        asyncio.create_task(self.probe_loop())
+
+    async def probe_loop(self) -> None:
+        """Checks all machines every hive_probe_interval seconds, forever.
+
+        The first check runs right away, so machines restored from the
+        registry get requests again as soon as they answer.
+        """
+        while True:
+            await self.probe_all()
+            await asyncio.sleep(hive_probe_interval)
+
+    async def probe_all(self) -> None:
+        """Checks all machines at once.
+
+        Machines that fail hive_unhealthy_after checks in a row get no more
+        requests until they answer again, after hive_evict_after failures
+        or hive_node_ttl hours they are dropped.
+        """
+        hivebots = list(self.hivebots)
+        if not hivebots:
+            return
+        was_healthy = [hivebot.healthy for hivebot in hivebots]
+        await asyncio.gather(*[hivebot.probe() for hivebot in hivebots])
+        # Models change with requests (see set_checkpoint), keep track of them
+        await asyncio.gather(*[hivebot.refresh_checkpoint() for hivebot in hivebots
+                               if hivebot.failures == 0])
+        for hivebot, healthy in zip(hivebots, was_healthy):
+            name = hivebot.nickname or hivebot.url
+            if hivebot.expired or hivebot.failures >= hive_evict_after:
+                print("Hive machine " + name + " dropped")
+                await self.remove_client(hivebot)
+            elif healthy != hivebot.healthy:
+                print("Hive machine " + name + " is " +
+                      ("healthy" if hivebot.healthy else "unhealthy"))
+        if self.registry is not None:
+            self.registry.save([hivebot for hivebot in hivebots
+                                if hivebot in self.hivebots])
+
+    def add_client(self, hivebot: HiveBot) -> None:
+        """Adds a machine, replacing an earlier registration of its URL."""
+        self.hivebots = [other for other in self.hivebots
+                         if other.url != hivebot.url]
+        self.hivebots.append(hivebot)
+        if self.registry is not None:
+            self.registry.save([hivebot])
+
+    async def remove_client(self, hivebot: HiveBot) -> None:
+        """Drops a machine from the hive and closes its connections."""
+        if hivebot not in self.hivebots:
+            # Already gone or registered again in the meantime
+            return
+        self.hivebots.remove(hivebot)
+        if self.registry is not None:
+            self.registry.remove(hivebot.url)
+        await session_pool.close_host(hivebot.url)
+
+    @contextlib.contextmanager
+    def track(self, hivebot: HiveBot | None) -> Iterator[None]:
+        """Counts a request as outstanding on the machine while it runs."""
+        if hivebot is None:
+            yield
+            return
+        hivebot.in_flight += 1
         try:
-            return random.choice(self.hivebots)
-        except:
-            return None
+            yield
+        finally:
+            hivebot.in_flight -= 1
 
     # all this command does is call the "main" draw_image method on
     # a random hivebot machine
@@ -102,15 +489,22 @@ class Hive(interactions.Extension):
                                  # fields together later so dont overdo it
                 required=False,
             ),
+            interactions.Option(
+                name="checkpoint",
+                description="Model to draw with, machines that have it loaded are preferred",
+                type=interactions.OptionType.STRING,
+                min_length=0,
+                max_length=200,
+                required=False,
+            ),
         ]
     )
     async def draw_hivemind(self, ctx: interactions.CommandContext, prompt: str = "",
                             seed: int = -1, quantity: int = 1,
-                            negative_prompt: str = "") -> None:
-        # select a random machine from the hivemind or fail if there are none
-        try:
-            hivebot = random.choice(self.hivebots)
-        except IndexError:
+                            negative_prompt: str = "", checkpoint: str = "") -> None:
+        # select a machine from the hivemind or fail if there are none
+        hivebot = await self.pick_client(checkpoint)
+        if hivebot is None:
             await ctx.send("Unfortunately, there are no bots in the hivemind right now",
                            ephemeral=True)
             return
@@ -121,8 +515,10 @@ class Hive(interactions.Extension):
         #    await ctx.send("Your bot: " + str(hivebot.ip) + ":" + str(hivebot.port),
         #                   ephemeral=True)
 
-        await self.client.draw(ctx=ctx, prompt=prompt, seed=seed, quantity=quantity,
-                               negative_prompt=negative_prompt, host=hivebot.url)
+        with self.track(hivebot):
+            await self.client.draw(ctx=ctx, prompt=prompt, seed=seed, quantity=quantity,
+                                   negative_prompt=negative_prompt, host=hivebot.url,
+                                   checkpoint=checkpoint)
 
     @interactions.extension_command(
         name="register",
@@ -173,7 +569,7 @@ class Hive(interactions.Extension):
             access_token = await self.gradio_login(url, username, password)
 
         try:
-            await self.test_gradio_url(url, access_token)
+            gradio_config = await self.test_gradio_url(url, access_token)
         except VersionNotSupportedError as err:
             await ctx.send("That client URL is running SD Web UI version " +
                            err.foundver + " but we only support version 3.4/3.5",
@@ -185,15 +581,13 @@ class Hive(interactions.Extension):
             return
 
         botconfig = {}
-        r = requests.get(url + "/config", timeout=2,
-                         cookies={"access-token": access_token}).json()
-        for component in r["components"]:
+        for component in gradio_config.get("components", []):
             if component["props"].get("label") == "Stop At last layers of CLIP model":
                 botconfig["CLIP"] = component["props"].get("value")
             elif component["props"].get("label") == "Stable Diffusion checkpoint":
                 botconfig["checkpoint"] = component["props"].get("value")
 
-        self.hivebots.append(HiveBot(url, access_token, nickname, botconfig))
+        self.add_client(HiveBot(url, access_token, nickname, botconfig))
 
         if nickname is not None:
             await ctx.send("client URL added to hivemind with nickname " + nickname, ephemeral=True)
@@ -202,13 +596,20 @@ class Hive(interactions.Extension):
 
     # attempt to login with the user-provided credentials and obtain an access token
     async def gradio_login(self, url: str, username: str, password: str) -> str | None:
-        r = requests.post(
-            url + "/login", data={"username": username, "password": password},
-            allow_redirects=False)
-        return r.cookies.get("access-token")
+        session = session_pool.get(url)
+        try:
+            async with session.post(
+                    url + "/login", data={"username": username, "password": password},
+                    allow_redirects=False,
+                    timeout=client_timeout(status_timeout)) as r:
+                cookie = r.cookies.get("access-token")
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+        return cookie.value if cookie is not None else None
 
     # check whether the machine URL provided by the user looks like a valid SD Web UI
-    async def test_gradio_url(self, url: str, access_token: str = None) -> None:
+    # and return its gradio config
+    async def test_gradio_url(self, url: str, access_token: str = None) -> dict:
         try:
             # using urllib here is a little limiting because it requires the user
             # to include the URL scheme (https://), otherwise the url is not
@@ -217,22 +618,30 @@ class Hive(interactions.Extension):
 
             # check whether the URL points to a subdomain under "gradio.app", these
             # are the only URLs Gradio's share mode will generate
-            if parsed.hostname[-11:] != ".gradio.app":
-                raise URLError
-
-            if access_token is not None:
-                resp = requests.get(url + "/config", timeout=2,
-                                    cookies={"access-token": access_token}).json()
-            else:
-                resp = requests.get(url + "/config", timeout=2).json()
-        except HTTPError:
+            if not parsed.hostname or parsed.hostname[-11:] != ".gradio.app":
+                raise URLError("not a gradio.app share link")
+
+            resp = await self.get_gradio_config(url, access_token)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
             raise NoSdWebUiError
         except URLError:
             raise NoSdWebUiError
 
         # only allow versions we currently support
-        if resp["version"] not in ["3.5\n", "3.4b3\n"]:
-            raise VersionNotSupportedError(resp["version"])
+        if resp.get("version") not in ["3.5\n", "3.4b3\n"]:
+            raise VersionNotSupportedError(str(resp.get("version")))
+        return resp
+
+    # fetch the gradio /config of a machine without blocking the other users
+    async def get_gradio_config(self, url: str, access_token: str = None) -> dict:
+        cookies = None
+        if access_token is not None:
+            cookies = {"access-token": access_token}
+        session = session_pool.get(url)
+        async with session.get(url + "/config", cookies=cookies,
+                               timeout=client_timeout(status_timeout)) as resp:
+            resp.raise_for_status()
+            return await resp.json(content_type=None)
 
 
 def setup(client: interactions.Client) -> None:
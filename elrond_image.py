@@ -0,0 +1,206 @@
+import base64
+import hashlib
+
+
+class SdImage():
+    """An image moving between Discord, the bot and the webui.
+
+    The webui API speaks base64, Discord and the disk want raw bytes. An
+    SdImage holds whichever form it was created from and converts to the
+    other one lazily, at most once, so a picture that goes
+    webui -> upscaler -> Discord is never decoded or encoded twice and no
+    "data:image/png;base64," prefixed copies are made along the way.
+    """
+
+    _data: bytes | None
+    _encoded: str | None
+    _sha256: str | None
+
+    def __init__(self, data: bytes | None = None,
+                 encoded: str | None = None) -> None:
+        """Constructor method, use from_bytes() or from_base64() instead."""
+        if data is None and encoded is None:
+            raise ValueError("SdImage needs either raw bytes or base64 data")
+        self._data = data
+        self._encoded = encoded
+        self._sha256 = None
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "SdImage":
+        """Creates an image from raw file bytes, e.g. a download or a file
+        read from the upscale cache.
+
+        The bytes are kept as they are and only encoded to base64 when the
+        webui needs them.
+        """
+        return cls(data=data)
+
+    @classmethod
+    def from_base64(cls, encoded: str) -> "SdImage":
+        """Creates an image from a base64 string as returned by the webui.
+
+        A leading "data:image/...;base64," prefix is accepted and dropped.
+        """
+        if encoded.startswith("data:"):
+            encoded = encoded[encoded.find(",") + 1:]
+        return cls(encoded=encoded)
+
+    @property
+    def data(self) -> bytes:
+        """The raw image file bytes, decoded on first access."""
+        if self._data is None:
+            self._data = base64.b64decode(self._encoded)
+        return self._data
+
+    @property
+    def base64(self) -> str:
+        """The image as plain base64 without prefix, encoded on first access.
+
+        The webui accepts this form for every image parameter.
+        """
+        if self._encoded is None:
+            self._encoded = base64.b64encode(self._data).decode("ascii")
+        return self._encoded
+
+    @property
+    def sha256(self) -> str:
+        """Hex digest of the raw image bytes, used as content address."""
+        if self._sha256 is None:
+            self._sha256 = hashlib.sha256(self.data).hexdigest()
+        return self._sha256
+
+    def __len__(self) -> int:
+        """Size of the raw image file in bytes."""
+        return len(self.data)
+
+
+class ImageStreamDecoder():
+    """Incrementally pulls base64 images out of a webui JSON response.
+
+    The webui answers generation and upscale calls with one JSON object that
+    holds the images as base64 strings, either as a list ("images") or as a
+    single string ("image"). Parsing that with json.loads keeps the whole
+    body, the decoded dict and every base64 string in memory at once. This
+    decoder is fed the body chunk by chunk and returns each image as raw
+    bytes as soon as its string is complete, everything else in the
+    response is skipped. Only the top level object is inspected.
+    """
+
+    # Decode pending base64 in blocks of this many characters
+    decode_block = 65536
+
+    def __init__(self, key: str = "images") -> None:
+        """Constructor method.
+
+        Args:
+            key: The top level key holding the image or list of images.
+        """
+        self.key = key.encode("utf-8")
+        self._depth = 0
+        self._expect_key = False
+        self._current_key = b""
+        self._in_target_list = False
+        self._in_string = False
+        self._string_is_key = False
+        self._capturing = False
+        self._escape = False
+        self._key_buf = bytearray()
+        self._pending = bytearray()
+        self._image = bytearray()
+
+    def feed(self, chunk: bytes) -> list[bytes]:
+        """Parses the next piece of the response body.
+
+        Args:
+            chunk: The next bytes of the body, of any size.
+
+        Returns:
+            The images completed within this chunk, possibly none.
+        """
+
+        images = []
+        i = 0
+        n = len(chunk)
+        while i < n:
+            if self._in_string:
+                if self._escape:
+                    # The character after a backslash. Base64 only ever
+                    # contains an escaped "/", keys and skipped strings
+                    # don't matter
+                    self._escape = False
+                    if self._capturing and chunk[i] == 0x2f:
+                        self._pending.append(0x2f)
+                    elif self._string_is_key:
+                        self._key_buf.append(chunk[i])
+                    i += 1
+                    continue
+                end = chunk.find(b'"', i)
+                backslash = chunk.find(b"\\", i, n if end == -1 else end)
+                stop = backslash if backslash != -1 else end
+                segment_end = n if stop == -1 else stop
+                if self._capturing:
+                    self._pending += chunk[i:segment_end]
+                    if len(self._pending) >= self.decode_block:
+                        self._decode_pending()
+                elif self._string_is_key:
+                    self._key_buf += chunk[i:segment_end]
+                if stop == -1:
+                    break
+                i = stop + 1
+                if stop == backslash:
+                    self._escape = True
+                    continue
+                # Closing quote
+                self._in_string = False
+                if self._capturing:
+                    images.append(self._finish_image())
+                    self._capturing = False
+                elif self._string_is_key:
+                    self._current_key = bytes(self._key_buf)
+                    self._string_is_key = False
+                continue
+
+            c = chunk[i]
+            i += 1
+            if c == 0x22:  # "
+                self._in_string = True
+                if self._depth == 1 and self._expect_key:
+                    self._string_is_key = True
+                    self._key_buf = bytearray()
+                elif ((self._depth == 1 and self._current_key == self.key) or
+                      (self._depth == 2 and self._in_target_list)):
+                    self._capturing = True
+            elif c == 0x7b or c == 0x5b:  # { [
+                self._depth += 1
+                if self._depth == 1:
+                    self._expect_key = True
+                elif (self._depth == 2 and c == 0x5b and
+                      self._current_key == self.key):
+                    self._in_target_list = True
+            elif c == 0x7d or c == 0x5d:  # } ]
+                self._depth -= 1
+                if self._depth == 1:
+                    self._in_target_list = False
+            elif self._depth == 1 and c == 0x3a:  # :
+                self._expect_key = False
+            elif self._depth == 1 and c == 0x2c:  # ,
+                self._expect_key = True
+                self._current_key = b""
+        return images
+
+    def _decode_pending(self) -> None:
+        usable = len(self._pending) - len(self._pending) % 4
+        if usable:
+            self._image += base64.b64decode(self._pending[:usable])
+            del self._pending[:usable]
+
+    def _finish_image(self) -> bytes:
+        self._decode_pending()
+        if self._pending:
+            # Unpadded leftovers, let the decoder complain if they are broken
+            self._image += base64.b64decode(self._pending + b"=" *
+                                            (-len(self._pending) % 4))
+        image = bytes(self._image)
+        self._pending = bytearray()
+        self._image = bytearray()
+        return image
@@ -0,0 +1,226 @@
+import asyncio
+import time
+
+import interactions
+from dotenv import dotenv_values
+
+config = dotenv_values(".env")
+# Seconds between two progress edits of the same message at least
+message_edit_interval = float(config.get("MESSAGE_EDIT_INTERVAL") or 1.0)
+# Discord allows about 5 message edits per 5 seconds per channel. This is a
+# fixed guess, Discord's real limit is only known from its response headers
+channel_edit_burst = int(config.get("CHANNEL_EDIT_BURST") or 5)
+channel_edit_period = float(config.get("CHANNEL_EDIT_PERIOD") or 5.0)
+# Error codes of edits refused for going too fast (31001 is the gateway's)
+rate_limit_codes = [429, 31001]
+
+
+class ChannelBucket():
+    """Client side approximation of Discord's per-channel edit rate limit.
+
+    A token bucket holding `burst` edits that refills over `period` seconds.
+    The numbers are static configuration, not read from Discord's rate
+    limit headers (the library keeps those to itself), so they may be off
+    from the real limit. Waiting for a token here is cheap; running into
+    the real limit makes the Discord library back off and hold up every
+    other request as well.
+    """
+
+    def __init__(self, burst: int, period: float) -> None:
+        """Constructor method.
+
+        Args:
+            burst: Edits allowed in a row.
+            period: Seconds until a completely drained bucket is full again.
+        """
+        self.burst = burst
+        self.rate = burst / period
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    async def acquire(self) -> None:
+        """Waits until an edit may be sent and takes its token."""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = self.blocked_until - now
+            if wait <= 0 and self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(max(wait, (1 - self.tokens) / self.rate))
+
+    def penalize(self, seconds: float) -> None:
+        """Blocks the channel for a while, e.g. after an edit was refused."""
+        self.tokens = 0
+        self.blocked_until = max(self.blocked_until,
+                                 time.monotonic() + seconds)
+
+
+# channel id -> its bucket, shared by all messages in that channel
+channel_buckets: dict[str, ChannelBucket] = {}
+
+
+def get_channel_bucket(channel_id) -> ChannelBucket:
+    """Returns the edit rate limit bucket of a channel."""
+    key = str(channel_id)
+    bucket = channel_buckets.get(key)
+    if bucket is None:
+        bucket = ChannelBucket(channel_edit_burst, channel_edit_period)
+        channel_buckets[key] = bucket
+    return bucket
+
+
+class MessageUpdater():
+    """Updates one bot message while its work is in progress.
+
+    Progress updates (titles, queue positions, ...) only ever send embeds
+    and components, attachments already on the message stay untouched and
+    nothing is uploaded. Files are sent exactly once, with finish(), when
+    they are final. Without this every progress edit re-uploaded all
+    pictures just to change a title.
+
+    Progress updates are also coalesced: only the latest state is kept and
+    it is sent at most every `interval` seconds and within the channel's
+    rate limit, states that get replaced in the meantime are never sent.
+    """
+
+    message: interactions.Message
+    interval: float
+
+    def __init__(self, message: interactions.Message,
+                 interval: float = message_edit_interval) -> None:
+        """Constructor method.
+
+        Args:
+            message: The bot message to keep up to date.
+            interval: Seconds between two progress edits at least.
+        """
+        self.message = message
+        self.interval = interval
+        self._bucket = get_channel_bucket(message.channel_id)
+        self._pending = None
+        self._task = None
+        self._editing = False
+        self._last_edit = 0.0
+        self._sent_files = False
+        self._last_state = None
+        self._closed = False
+
+    async def progress(self, embeds: list[interactions.Embed],
+                       components=interactions.MISSING,
+                       files: list[interactions.File] | None = None) -> None:
+        """Shows a new progress state, usually text and embeds only.
+
+        Returns right away, the edit is sent in the background.
+
+        Args:
+            embeds: The embeds to show. They shouldn't reference attachments
+                that haven't been uploaded yet.
+            components: New buttons, if they changed.
+            files: Temporary attachments, e.g. a small preview. They replace
+                all attachments of the message. Keep them rare and small.
+        """
+        if self._closed:
+            return
+        # Copy the embeds, the caller keeps changing them
+        embeds = [interactions.Embed(**embed._json) for embed in embeds]
+        if files is None and self._pending is not None:
+            # The embeds may point to files that haven't been sent yet
+            files = self._pending[2]
+        self._pending = (embeds, components, files)
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush())
+
+    async def finish(self, embeds: list[interactions.Embed], components,
+                     files: list[interactions.File] | None = None,
+                     **kwargs) -> None:
+        """Shows the final state and uploads the attachments.
+
+        Pending progress states are dropped, the final state is always sent
+        unless discard() was called in the meantime.
+
+        Args:
+            embeds: The final embeds.
+            components: The final buttons.
+            files: Attachments to upload, in their final form. They replace
+                temporary attachments sent with progress().
+            **kwargs: Passed on to Message.edit, e.g. content.
+        """
+        await self._drop_pending()
+        if files is not None:
+            kwargs["files"] = files
+            if self._sent_files:
+                kwargs.setdefault("attachments", [])
+        await self._bucket.acquire()
+        if self._closed:
+            # Cancelled or deleted while waiting for the channel
+            return
+        await self._edit(final=True, embeds=embeds, components=components,
+                         **kwargs)
+
+    async def discard(self) -> None:
+        """Drops pending progress states and ignores all further ones.
+
+        For when the message is about to be deleted or its work was
+        cancelled. Waits for an edit that is already on its way.
+        """
+        self._closed = True
+        await self._drop_pending()
+
+    async def _drop_pending(self) -> None:
+        self._pending = None
+        task = self._task
+        if task is None:
+            return
+        if self._editing:
+            await task
+        else:
+            task.cancel()
+            self._task = None
+
+    async def _flush(self) -> None:
+        try:
+            while self._pending is not None:
+                wait = self._last_edit + self.interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                await self._bucket.acquire()
+                if self._pending is None:
+                    break
+                embeds, components, files = self._pending
+                self._pending = None
+                kwargs = {}
+                if files is not None:
+                    kwargs = {"files": files, "attachments": []}
+                state = ([embed._json for embed in embeds], id(components))
+                if not kwargs and state == self._last_state:
+                    # Nothing visible changed
+                    continue
+                self._last_state = state
+                self._editing = True
+                try:
+                    await self._edit(embeds=embeds, components=components,
+                                     **kwargs)
+                    self._sent_files = self._sent_files or bool(kwargs)
+                finally:
+                    self._editing = False
+        finally:
+            if self._task is asyncio.current_task():
+                self._task = None
+
+    async def _edit(self, final: bool = False, **kwargs) -> None:
+        try:
+            await self.message.edit(**kwargs)
+        except interactions.LibraryException as e:
+            print("Message edit failed: " + str(e))
+            if e.code in rate_limit_codes:
+                # The library didn't get through its own retries, give the
+                # channel a break
+                self._bucket.penalize(self.interval * 5)
+            if final and "files" in kwargs:
+                # The caller has to know its pictures didn't make it
+                raise
+        self._last_edit = time.monotonic()
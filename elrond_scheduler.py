@@ -0,0 +1,461 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict, deque
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+from dotenv import dotenv_values
+
+from elrond_image import SdImage
+from elrond_sd_interface import (interface_txt2img, latency_stats,
+                                 max_concurrent_jobs)
+
+config = dotenv_values(".env")
+batch_window_ms = int(config.get("BATCH_WINDOW_MS") or 0) # 0 disables cross-request batching
+max_merged_batch = int(config.get("MAX_MERGED_BATCH") or 4)
+# Seconds after which a low priority job queues like a normal one, 0 never
+priority_aging_seconds = float(config.get("PRIORITY_AGING_SECONDS") or 60)
+
+
+class Job():
+    """A single unit of GPU work waiting for or running on a backend."""
+
+    host: str
+    user: str
+    call: Callable[[], Awaitable[Any]]
+    on_position: Callable[[int], Awaitable[None]] | None
+    priority: int
+    cost: float | None
+    future: asyncio.Future
+    position: int | None
+    task: asyncio.Task | None
+    queued: float
+    started: float | None
+
+    def __init__(self, host: str, user: str,
+                 call: Callable[[], Awaitable[Any]],
+                 on_position: Callable[[int], Awaitable[None]] | None = None,
+                 priority: int = 0, cost: float | None = None) -> None:
+        """Constructor method.
+
+        Args:
+            host: The backend (webui base URL) the job runs on.
+            user: Whoever requested it, jobs are interleaved per user.
+            call: Starts the actual webui request once it's the job's turn.
+            on_position: Optional coroutine function, called with the job's
+                1-based queue position whenever it changes and with 0 when
+                the job starts running.
+            priority: Jobs with a higher number only get a slot while no
+                job with a lower number is waiting, e.g. final renders of
+                drafts that can still be cancelled (1), or the upscale of a
+                picture that was just drawn (-1). Jobs above 0 that waited
+                too long count as 0, see Scheduler.
+            cost: Expected seconds the job keeps the backend busy, see
+                elrond_sd_interface.latency_stats. None if unknown.
+        """
+        self.host = host
+        self.user = user
+        self.call = call
+        self.on_position = on_position
+        self.priority = priority
+        self.cost = cost
+        self.future = asyncio.get_running_loop().create_future()
+        self.position = None
+        self.task = None
+        self.queued = time.monotonic()
+        self.started = None
+
+
+class _Backend():
+    """Queue state of one backend."""
+
+    def __init__(self, aging: float) -> None:
+        self.aging = aging
+        # priority -> user -> their queued jobs, in order of arrival
+        self.queues: dict[int, OrderedDict[str, deque[Job]]] = {}
+        # user -> number of the dispatch that last gave them a slot
+        self.last_served: dict[str, int] = {}
+        self.dispatches = 0
+        self.running: set[Job] = set()
+        # False while the webui is starting, jobs only queue up meanwhile
+        self.ready = True
+
+    def dispatch_order(self) -> list[Job]:
+        """Returns all queued jobs in the order they will get a slot.
+
+        Lower priority numbers go first, jobs above 0 that waited longer
+        than `aging` seconds count as 0. Within a priority the next slot
+        goes to the waiting user who was served longest ago (or never),
+        ties go to whoever queued first.
+        """
+        now = time.monotonic()
+        # priority -> user -> their jobs, in order of arrival
+        groups: dict[int, dict[str, list[Job]]] = {}
+        for priority, queues in self.queues.items():
+            for user, queue in queues.items():
+                for job in queue:
+                    aged = priority > 0 and self.aging and \
+                        now - job.queued >= self.aging
+                    groups.setdefault(0 if aged else priority, {}).setdefault(
+                        user, []).append(job)
+
+        last_served = dict(self.last_served)
+        order = []
+        dispatches = self.dispatches
+        for priority in sorted(groups):
+            queues = {user: sorted(jobs, key=lambda job: job.queued)
+                      for user, jobs in groups[priority].items()}
+            while queues:
+                user = min(queues, key=lambda u: (last_served.get(u, -1),
+                                                  queues[u][0].queued))
+                order.append(queues[user].pop(0))
+                if not queues[user]:
+                    del queues[user]
+                last_served[user] = dispatches
+                dispatches += 1
+        return order
+
+    def remove(self, job: Job) -> None:
+        """Takes a queued job out of its queue."""
+        queues = self.queues[job.priority]
+        queue = queues[job.user]
+        queue.remove(job)
+        if not queue:
+            del queues[job.user]
+            if not queues:
+                del self.queues[job.priority]
+
+
+class Scheduler():
+    """Queues GPU jobs per backend and hands them out fairly.
+
+    Each backend runs at most `max_concurrency` jobs at once, everything else
+    waits here instead of piling up behind the webui's internal lock. Free
+    slots go to users in round-robin order (whoever was served longest ago
+    goes next), so someone queueing a lot of jobs only gets every n-th slot
+    while n users are waiting. Low priority jobs wait until no normal job
+    is left, or until they waited `aging` seconds, so a steady stream of
+    normal jobs can't hold them back forever.
+
+    A backend that isn't ready yet (see set_ready) only collects jobs, they
+    start once it is.
+
+    Cancelling a job's future cancels the job: if it is still queued it is
+    dropped and never reaches the webui, if it is running its call is
+    cancelled, which makes the webui interrupt it (see
+    elrond_sd_interface.post_for_images).
+    """
+
+    max_concurrency: int
+    aging: float
+
+    def __init__(self, max_concurrency: int = 1, aging: float = 0) -> None:
+        """Constructor method.
+
+        Args:
+            max_concurrency: Jobs running at the same time per backend.
+            aging: Seconds after which a low priority job is treated like a
+                normal one, 0 never.
+        """
+        self.max_concurrency = max_concurrency
+        self.aging = aging
+        self._backends: dict[str, _Backend] = {}
+
+    async def run(self, host: str, user: str,
+                  call: Callable[[], Awaitable[Any]],
+                  on_position: Callable[[int], Awaitable[None]] | None = None,
+                  priority: int = 0, cost: float | None = None) -> Any:
+        """Queues call() on the backend and returns its result once done.
+
+        Args:
+            host: The backend (webui base URL) the job runs on.
+            user: Whoever requested it.
+            call: Starts the actual webui request.
+            on_position: See Job.
+            priority: See Job.
+            cost: See Job.
+
+        Returns:
+            Whatever call() returned. Exceptions are passed on as well.
+        """
+        return await self.submit(Job(host, user, call, on_position,
+                                     priority, cost))
+
+    def submit(self, job: Job) -> asyncio.Future:
+        """Queues a job and returns the future of its result."""
+        backend = self._backends.setdefault(job.host, _Backend(self.aging))
+        queues = backend.queues.setdefault(job.priority, OrderedDict())
+        queues.setdefault(job.user, deque()).append(job)
+        job.future.add_done_callback(lambda _: self._cancelled(job, backend))
+        self._dispatch(backend)
+        return job.future
+
+    def set_ready(self, host: str, ready: bool) -> None:
+        """Marks a backend as ready for jobs, or holds its jobs back.
+
+        Backends are ready unless told otherwise.
+        """
+        backend = self._backends.setdefault(host, _Backend(self.aging))
+        backend.ready = ready
+        if ready:
+            self._dispatch(backend)
+
+    def is_ready(self, host: str) -> bool:
+        """Returns False while jobs for the backend are held back."""
+        backend = self._backends.get(host)
+        return backend is None or backend.ready
+
+    def queue_length(self, host: str) -> int:
+        """Returns how many jobs are waiting for the backend."""
+        backend = self._backends.get(host)
+        if backend is None:
+            return 0
+        return sum(len(queue) for queues in backend.queues.values()
+                   for queue in queues.values())
+
+    def expected_wait(self, host: str, position: int) -> float | None:
+        """Estimates the seconds until the job at a queue position starts.
+
+        Adds up the remaining cost of the running jobs and the cost of the
+        queued jobs ahead, shared by the backend's slots.
+
+        Returns:
+            The estimate, or None if a job's cost is unknown or the backend
+            isn't ready.
+        """
+        backend = self._backends.get(host)
+        if backend is None:
+            return 0.0
+        if not backend.ready:
+            return None
+        now = time.monotonic()
+        wait = 0.0
+        for job in backend.running:
+            if job.cost is None:
+                return None
+            wait += max(0.0, job.cost - (now - job.started))
+        for job in backend.dispatch_order()[:position - 1]:
+            if job.cost is None:
+                return None
+            wait += job.cost
+        return wait / self.max_concurrency
+
+    def _dispatch(self, backend: _Backend) -> None:
+        while (backend.ready and len(backend.running) < self.max_concurrency
+               and backend.queues):
+            job = backend.dispatch_order()[0]
+            backend.remove(job)
+            backend.last_served[job.user] = backend.dispatches
+            backend.dispatches += 1
+            backend.running.add(job)
+            # Mark it running right away, it can't be dropped anymore
+            job.position = 0
+            job.started = time.monotonic()
+            job.task = asyncio.create_task(self._run(job, backend))
+        if not backend.queues and not backend.running:
+            # Backend idle, nobody needs to be ranked against history anymore
+            backend.last_served.clear()
+        self._update_positions(backend)
+
+    async def _run(self, job: Job, backend: _Backend) -> None:
+        if job.on_position is not None:
+            asyncio.create_task(job.on_position(0))
+        try:
+            result = await job.call()
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            backend.running.discard(job)
+            self._dispatch(backend)
+
+    def _cancelled(self, job: Job, backend: _Backend) -> None:
+        if not job.future.cancelled():
+            return
+        if job.position == 0:
+            if job.task is not None:
+                job.task.cancel()
+        else:
+            backend.remove(job)
+            self._dispatch(backend)
+
+    def _update_positions(self, backend: _Backend) -> None:
+        for position, job in enumerate(backend.dispatch_order(), start=1):
+            self._notify(job, position)
+
+    def _notify(self, job: Job, position: int) -> None:
+        if job.position == position:
+            return
+        job.position = position
+        if job.on_position is not None:
+            asyncio.create_task(job.on_position(position))
+
+
+class _PendingBatch():
+    """txt2img requests waiting to be merged into one webui call."""
+
+    def __init__(self, host: str, prompt: str, negative_prompt: str,
+                 options: dict, seed: int) -> None:
+        self.host = host
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.options = options
+        # The first request's seed, the others continue from there
+        self.seed = seed
+        # (user, future, on_position) per request, in order of arrival
+        self.entries: list[tuple[str, asyncio.Future,
+                                 Callable[[int], Awaitable[None]] | None]] = []
+        self.timer: asyncio.TimerHandle | None = None
+        # Draws the batch, once it is flushed
+        self.task: asyncio.Task | None = None
+
+
+class Batcher():
+    """Merges compatible single image txt2img requests into one batch.
+
+    Requests that only differ in their (random) seed are held for a short
+    window and then sent to the webui as a single call with a larger
+    batch_size, which keeps the GPU busy with several latents at once
+    instead of one after another. The webui numbers the images of a batch
+    seed, seed + 1, ..., so every request gets its own seed out of that
+    range and its own image back.
+
+    The webui API takes exactly one prompt per call, so only requests with
+    the same prompt and negative prompt can share a batch. That is the
+    common case under load: several people pressing "Try again!" on the
+    same picture.
+
+    A request that gets cancelled leaves its batch, the batch itself is
+    only cancelled once nobody is left waiting for it.
+    """
+
+    def __init__(self, scheduler: "Scheduler", window: float,
+                 max_batch: int) -> None:
+        """Constructor method.
+
+        Args:
+            scheduler: Where the merged jobs are queued.
+            window: Seconds to wait for more requests, 0 disables merging.
+            max_batch: Requests per merged call at most.
+        """
+        self.scheduler = scheduler
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: dict[str, _PendingBatch] = {}
+
+    async def txt2img(self, host: str, user: str, prompt: str, seed: int,
+                      negative_prompt: str = "",
+                      on_position: Callable[[int], Awaitable[None]] | None = None,
+                      **options: Any) -> tuple[int, list[SdImage]]:
+        """Draws one image, possibly as part of a batch with other requests.
+
+        Only use this for single images with a random seed and no prompt
+        matrix, the seed may be replaced.
+
+        Args:
+            host: The backend (webui base URL).
+            user: Whoever requested it.
+            prompt: The text prompt.
+            seed: The seed to use if the request isn't merged.
+            negative_prompt: The negative prompt.
+            on_position: See Job.
+            **options: Further interface_txt2img arguments, e.g. the hires
+                fix settings. Only requests with equal options are merged.
+
+        Returns:
+            The seed the image was actually drawn with, and a list holding
+            just that image (empty if drawing failed).
+        """
+        if self.window <= 0:
+            cost = latency_stats.estimate(host, "/sdapi/v1/txt2img")
+            images = await interface_txt2img(
+                prompt=prompt, seed=seed, negative_prompt=negative_prompt,
+                host=host,
+                queue=lambda call: self.scheduler.run(
+                    host, user, call, on_position=on_position, cost=cost),
+                **options)
+            return seed, images
+
+        key = json.dumps([host, prompt, negative_prompt, options],
+                         sort_keys=True)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = _PendingBatch(host, prompt, negative_prompt, options, seed)
+            self._pending[key] = batch
+            batch.timer = asyncio.get_running_loop().call_later(
+                self.window, self._flush, key, batch)
+        future = asyncio.get_running_loop().create_future()
+        batch.entries.append((user, future, on_position))
+        future.add_done_callback(lambda _: self._cancelled(key, batch, future))
+        if len(batch.entries) >= self.max_batch:
+            batch.timer.cancel()
+            self._flush(key, batch)
+        return await future
+
+    def _cancelled(self, key: str, batch: _PendingBatch,
+                   future: asyncio.Future) -> None:
+        if not future.cancelled():
+            return
+        if batch.task is None:
+            # Not sent yet, just leave the batch
+            batch.entries = [entry for entry in batch.entries
+                             if entry[1] is not future]
+            if not batch.entries and self._pending.get(key) is batch:
+                batch.timer.cancel()
+                del self._pending[key]
+        elif all(entry[1].done() for entry in batch.entries):
+            batch.task.cancel()
+
+    def _flush(self, key: str, batch: _PendingBatch) -> None:
+        if self._pending.get(key) is batch:
+            del self._pending[key]
+        if batch.entries:
+            batch.task = asyncio.create_task(self._run(batch))
+
+    async def _run(self, batch: _PendingBatch) -> None:
+        # The batch belongs to whoever asked first, one queue slot for all
+        user = batch.entries[0][0]
+        seed = batch.seed
+        size = len(batch.entries)
+
+        async def on_position(position: int) -> None:
+            for _, future, callback in batch.entries:
+                if callback is not None and not future.done():
+                    await callback(position)
+
+        cost = latency_stats.estimate(batch.host, "/sdapi/v1/txt2img", size)
+        try:
+            images = await interface_txt2img(
+                prompt=batch.prompt, seed=seed, quantity=size,
+                negative_prompt=batch.negative_prompt, host=batch.host,
+                batch_size=size,
+                queue=lambda call: self.scheduler.run(
+                    batch.host, user, call, on_position=on_position,
+                    cost=cost),
+                **batch.options)
+        except asyncio.CancelledError:
+            # Everybody left
+            return
+        except Exception as e:
+            for _, future, _ in batch.entries:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # Drop the grid the webui puts in front of multiple images
+        if len(images) > size:
+            images = images[len(images) - size:]
+        for i, (_, future, _) in enumerate(batch.entries):
+            if not future.done():
+                future.set_result((seed + i, images[i:i + 1]))
+
+
+scheduler = Scheduler(max_concurrent_jobs, priority_aging_seconds)
+batcher = Batcher(scheduler, batch_window_ms / 1000, max_merged_batch)
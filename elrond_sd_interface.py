@@ -1,86 +1,713 @@
-import base64
+import asyncio
+import contextlib
+import hashlib
 import json
 import random
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable, Iterator
+from typing import Any
+from urllib.parse import urlparse
 import aiohttp
 from dotenv import dotenv_values
+from elrond_cache import (DownloadCache, InterrogationCache, SingleFlight,
+                          UpscaleCache)
+from elrond_image import ImageStreamDecoder, SdImage
 
 config = dotenv_values(".env")
 debug_mode = bool(config["DEBUG_MODE"] == "True")
 use_webui_default_prompts = bool(config["USE_WEBUI_DEFAULT_PROMPTS"] == "True") # ToDo: This probably is not needed anymore
 sampling_method_txt2img = str(config["SAMPLING_METHOD_TXT2IMG"])
 sampling_method_img2img = str(config["SAMPLING_METHOD_IMG2IMG"])
+connections_per_host = int(config.get("CONNECTIONS_PER_HOST") or 4)
+dns_cache_ttl = int(config.get("DNS_CACHE_TTL") or 300)
+keepalive_timeout = int(config.get("KEEPALIVE_TIMEOUT") or 60)
+# Parse image responses incrementally instead of via response.json(). Debug
+# mode always reads the full JSON because it dumps it to a file.
+stream_image_responses = bool((config.get("STREAM_IMAGE_RESPONSES") or "True") == "True")
+stream_chunk_size = 65536
+max_batch_size = int(config.get("MAX_BATCH_SIZE") or 1) # Images rendered in parallel on the GPU
+# Per backend overrides, e.g. "http://localhost:7860=8,https://xxxxx.gradio.app=2"
+batch_size_profiles = {
+    host.strip(): int(size)
+    for host, _, size in (entry.rpartition("=") for entry in
+                          (config.get("BATCH_SIZE_PROFILES") or "").split(",")
+                          if entry.strip())
+}
+download_cache_mb = int(config.get("DOWNLOAD_CACHE_MB") or 128) # 0 disables the cache
+download_cache_ttl = int(config.get("DOWNLOAD_CACHE_TTL") or 3600)
+interrogate_cache_size = int(config.get("INTERROGATE_CACHE_SIZE") or 1024)
+interrogate_cache_db = config.get("INTERROGATE_CACHE_DB") or None # Empty keeps the cache in memory only
+upscale_cache_dir = config.get("UPSCALE_CACHE_DIR") or ".upscale_cache"
+upscale_cache_mb = int(config.get("UPSCALE_CACHE_MB") or 1024) # 0 disables the cache
+# Seconds. Connecting gets its own short budget, the rest covers the whole call
+connect_timeout = float(config.get("CONNECT_TIMEOUT") or 10)
+generation_timeout = float(config.get("GENERATION_TIMEOUT") or 600)
+upscale_timeout = float(config.get("UPSCALE_TIMEOUT") or 300)
+interrogate_timeout = float(config.get("INTERROGATE_TIMEOUT") or 120)
+download_timeout = float(config.get("DOWNLOAD_TIMEOUT") or 30)
+status_timeout = float(config.get("STATUS_TIMEOUT") or 10) # progress, interrupt
+# Idempotent calls (downloads, interrogations) are tried this often
+retry_attempts = int(config.get("RETRY_ATTEMPTS") or 3)
+retry_backoff = float(config.get("RETRY_BACKOFF") or 0.5) # Seconds, doubled per attempt
+# After this many failed calls in a row a backend is skipped for a while
+breaker_failures = int(config.get("BREAKER_FAILURES") or 5)
+breaker_cooldown = float(config.get("BREAKER_COOLDOWN") or 30)
+max_concurrent_jobs = int(config.get("MAX_CONCURRENT_JOBS") or 1) # Per backend, see elrond_scheduler
+
+
+class SessionPool():
+    """Long-lived aiohttp sessions, one per host.
+
+    Every host (the webui, hive nodes, the Discord CDN) gets its own session
+    with a keep-alive connector, so consecutive calls of one generation
+    (download, txt2img/img2img, upscale) reuse warm TCP/TLS connections
+    instead of opening a new one for every stage.
+    """
 
+    sessions: dict[str, aiohttp.ClientSession]
 
-async def download_image_from_url(img_url: str) -> str:
-    """Takes any URL and downloads the image from there, returns image data.
+    def __init__(self, limit_per_host: int = 4, dns_cache_ttl: int = 300,
+                 keepalive_timeout: int = 60) -> None:
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.sessions = {}
+
+    def get(self, url: str) -> aiohttp.ClientSession:
+        """Returns the session for the host of the given URL.
+
+        Must be called from within the running event loop, sessions are
+        created lazily on first use.
+
+        Args:
+            url: Any URL on the host, e.g. "http://localhost:7860/sdapi/v1/txt2img".
+
+        Returns:
+            The shared session for that host.
+        """
+
+        parsed = urlparse(url)
+        key = parsed.scheme + "://" + parsed.netloc
+        session = self.sessions.get(key)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout)
+            session = aiohttp.ClientSession(connector=connector)
+            self.sessions[key] = session
+        return session
+
+    async def close_host(self, url: str) -> None:
+        """Closes and forgets the session for the host of the given URL.
+
+        For hosts that won't be called again, e.g. evicted hive machines.
+        """
+
+        parsed = urlparse(url)
+        session = self.sessions.pop(parsed.scheme + "://" + parsed.netloc,
+                                    None)
+        if session is not None and not session.closed:
+            await session.close()
+
+    async def close(self) -> None:
+        """Closes all sessions, call this once when the bot stops."""
+
+        sessions = list(self.sessions.values())
+        self.sessions = {}
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+
+
+session_pool = SessionPool(connections_per_host, dns_cache_ttl,
+                           keepalive_timeout)
+
+
+# custom Exception classes for more fine-grained error handling
+class OutOfMemoryError(Exception):
+    """The webui ran out of VRAM while generating."""
+    pass
+
+
+class BackendUnavailableError(Exception):
+    """The webui can't be reached, timed out or is skipped for a while."""
+    pass
+
+
+def client_timeout(total: float) -> aiohttp.ClientTimeout:
+    """Returns the timeout for a call that may take `total` seconds."""
+    return aiohttp.ClientTimeout(total=total, sock_connect=connect_timeout)
+
+
+async def retry(call: Callable[[], Awaitable[Any]],
+                attempts: int = retry_attempts) -> Any:
+    """Runs call() again if it fails with a network error or timeout.
+
+    Waits a random time between attempts that doubles every time (full
+    jitter), so callers that failed together don't all come back at the
+    same moment. Only for calls that are safe to repeat.
 
     Args:
-        img_url: The URL to the image.
+        call: Starts the request.
+        attempts: How often to try at most.
+
+    Returns:
+        Whatever call() returned. The last error is raised if all attempts
+        failed.
+    """
+    for attempt in range(attempts):
+        try:
+            return await call()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt + 1 >= attempts:
+                raise
+            print("Attempt " + str(attempt + 1) + " failed, retrying: " +
+                  str(e))
+        await asyncio.sleep(random.uniform(0, retry_backoff * 2 ** attempt))
+
+
+class CircuitBreaker():
+    """Stops sending requests to a backend that keeps failing.
+
+    After `failures` calls in a row ran into network errors or timeouts,
+    the host's breaker opens and every call fails right away with a
+    BackendUnavailableError for `cooldown` seconds, instead of waiting for
+    yet another timeout. After that calls are let through again, the first
+    success closes the breaker, another failure opens it for the next
+    cooldown.
+    """
+
+    failures: int
+    cooldown: float
+
+    def __init__(self, failures: int, cooldown: float) -> None:
+        """Constructor method.
+
+        Args:
+            failures: Failed calls in a row that open the breaker.
+            cooldown: Seconds an open breaker stays open.
+        """
+        self.failures = failures
+        self.cooldown = cooldown
+        # host -> failed calls in a row
+        self._failed: dict[str, int] = {}
+        # host -> monotonic time the breaker closes again
+        self._open_until: dict[str, float] = {}
+
+    def is_open(self, host: str) -> bool:
+        """Returns True while calls to the host are skipped."""
+        return self._open_until.get(host, 0) > time.monotonic()
+
+    def check(self, host: str) -> None:
+        """Raises BackendUnavailableError while the host's breaker is open."""
+        if self.is_open(host):
+            raise BackendUnavailableError(
+                host + " failed " + str(self._failed[host]) +
+                " times in a row, trying again in " +
+                str(int(self._open_until[host] - time.monotonic()) + 1) +
+                " seconds")
+
+    @contextlib.contextmanager
+    def guard(self, host: str) -> Iterator[None]:
+        """Wraps one call to the host and keeps count of its outcome.
+
+        Network errors and timeouts inside are turned into a
+        BackendUnavailableError.
+        """
+        self.check(host)
+        try:
+            yield
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            failed = self._failed.get(host, 0) + 1
+            self._failed[host] = failed
+            if failed >= self.failures:
+                self._open_until[host] = time.monotonic() + self.cooldown
+                print("Backend " + host + " failed " + str(failed) +
+                      " times in a row, skipping it for " +
+                      str(self.cooldown) + " seconds")
+            raise BackendUnavailableError(
+                host + " is not answering: " +
+                (str(e) or type(e).__name__)) from e
+        self._failed.pop(host, None)
+        self._open_until.pop(host, None)
+
+
+class BatchPlanner():
+    """Decides how to split multi image requests into batch_size x n_iter.
+
+    Rendering images as one batch is much faster than one after another,
+    but needs VRAM for every latent at once. The allowed batch size per
+    backend comes from BATCH_SIZE_PROFILES (or MAX_BATCH_SIZE) and is
+    lowered whenever that backend runs out of memory, so it converges to
+    what the GPU can actually handle.
+    """
+
+    default_max: int
+    limits: dict[str, int]
+
+    def __init__(self, default_max: int, profiles: dict[str, int]) -> None:
+        """Constructor method.
+
+        Args:
+            default_max: Batch size limit for backends without a profile.
+            profiles: Configured batch size limit per backend URL.
+        """
+        self.default_max = default_max
+        self.limits = dict(profiles)
+
+    def limit(self, host: str) -> int:
+        """Returns the current batch size limit of the backend."""
+        return max(1, self.limits.get(host, self.default_max))
+
+    def plan(self, host: str, quantity: int,
+             preferred: int | None = None) -> tuple[int, int]:
+        """Returns (batch_size, n_iter) for `quantity` images on the backend.
+
+        The batch size is the largest divisor of `quantity` within the
+        backend's limit (and `preferred`, if given), so exactly `quantity`
+        images are made and image i keeps seed + i.
+        """
+        limit = self.limit(host)
+        if preferred is not None:
+            limit = min(limit, preferred)
+        batch_size = 1
+        for candidate in range(min(limit, quantity), 0, -1):
+            if quantity % candidate == 0:
+                batch_size = candidate
+                break
+        return batch_size, quantity // batch_size
+
+    def record_oom(self, host: str, batch_size: int) -> None:
+        """Lowers the backend's limit after a batch ran out of memory."""
+        self.limits[host] = min(self.limit(host), max(1, batch_size - 1))
+        print("Out of memory on " + host + " with batch size " +
+              str(batch_size) + ", limiting it to " +
+              str(self.limits[host]))
+
+
+batch_planner = BatchPlanner(max_batch_size, batch_size_profiles)
+
+
+class LatencyStats():
+    """Running estimate of how long webui calls take, per host and endpoint.
+
+    Keeps an exponentially weighted moving average of the seconds per image,
+    so recent measurements count most and a slow outlier fades out. Only
+    regular requests are recorded, drafts and warm-up calls with their own
+    step count or size, hires fix renders and requests that switch the
+    checkpoint would skew it.
+    """
+
+    alpha: float
+
+    def __init__(self, alpha: float = 0.3) -> None:
+        """Constructor method.
+
+        Args:
+            alpha: Weight of a new measurement, between 0 and 1.
+        """
+        self.alpha = alpha
+        # (host, endpoint) -> seconds per image
+        self._averages: dict[tuple[str, str], float] = {}
+
+    def record(self, host: str, endpoint: str, seconds: float,
+               images: int = 1) -> None:
+        """Adds the duration of a finished call.
+
+        Args:
+            host: The webui base URL.
+            endpoint: The API path, e.g. "/sdapi/v1/txt2img".
+            seconds: How long the call took.
+            images: How many images it produced or processed.
+        """
+        key = (host, endpoint)
+        per_image = seconds / max(images, 1)
+        average = self._averages.get(key)
+        if average is None:
+            self._averages[key] = per_image
+        else:
+            self._averages[key] = (self.alpha * per_image +
+                                   (1 - self.alpha) * average)
+
+    def estimate(self, host: str, endpoint: str,
+                 images: int = 1) -> float | None:
+        """Returns the expected seconds for a call, None if never measured."""
+        average = self._averages.get((host, endpoint))
+        if average is None:
+            return None
+        return average * images
+
+    def forget(self, host: str) -> None:
+        """Drops all measurements of a host, e.g. cold start numbers."""
+        for key in [key for key in self._averages if key[0] == host]:
+            del self._averages[key]
+
+
+download_cache = DownloadCache(download_cache_mb * 1024 * 1024,
+                               download_cache_ttl)
+interrogate_cache = InterrogationCache(interrogate_cache_size,
+                                       interrogate_cache_db)
+upscale_cache = UpscaleCache(upscale_cache_dir,
+                             upscale_cache_mb * 1024 * 1024)
+single_flight = SingleFlight()
+circuit_breaker = CircuitBreaker(breaker_failures, breaker_cooldown)
+latency_stats = LatencyStats()
+
+
+def request_key(url: str, request: dict) -> str:
+    """Returns a hash identifying a webui call for de-duplication.
+
+    Args:
+        url: The full endpoint URL, so different backends never share calls.
+        request: The JSON payload. Images should already be replaced by
+            their sha256 to keep the key cheap to compute.
+
+    Returns:
+        Hex digest of the canonical (sorted keys) JSON form of the call.
+    """
+
+    canonical = json.dumps([url, request], sort_keys=True)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def set_checkpoint(request: dict, checkpoint: str | None,
+                   keep_checkpoint: bool = False) -> None:
+    """Makes a txt2img/img2img request use the given model.
+
+    Args:
+        request: The JSON payload, changed in place.
+        checkpoint: The model as /sdapi/v1/sd-models lists it, its title or
+            model name. None or empty leaves the request alone.
+        keep_checkpoint: If True, the webui keeps the model loaded after the
+            request instead of switching back. Saves a model swap per
+            request on hive machines that are routed by their loaded model,
+            but on a shared webui it would change the model for everyone.
+    """
+
+    if checkpoint:
+        request["override_settings"] = {"sd_model_checkpoint": checkpoint}
+        request["override_settings_restore_afterwards"] = not keep_checkpoint
+
+
+async def stream_images(
+        response: aiohttp.ClientResponse,
+        key: str = "images"
+) -> AsyncIterator[bytes]:
+    """Yields the images of a webui response one at a time.
+
+    The body is read in chunks and fed through an ImageStreamDecoder, so
+    only the image currently being received is held in memory instead of
+    the whole JSON document and all of its base64 strings.
+
+    Args:
+        response: The webui response, body not yet read.
+        key: The top level JSON key holding the image(s), "images" for
+            txt2img/img2img and "image" for the single image upscaler.
+
+    Yields:
+        The raw bytes of each image, in response order.
+    """
+
+    decoder = ImageStreamDecoder(key)
+    async for chunk in response.content.iter_chunked(stream_chunk_size):
+        for image in decoder.feed(chunk):
+            yield image
+
+
+def owns_webui(host: str) -> bool:
+    """Whether a running request to the host is surely the webui's job.
+
+    Only true for the bot's own webui while the scheduler gives it one job
+    at a time. With more slots a request may still wait for the webui's
+    internal lock behind another one. Hive machines are used by their
+    owners and other bots as well.
+    """
+
+    return (max_concurrent_jobs == 1 and
+            host == config["GRADIO_API_BASE_URL"])
+
+
+async def post_for_images(
+        host: str,
+        endpoint: str,
+        request: dict,
+        debug_file: str,
+        timeout: float = generation_timeout,
+        interruptible: bool = True
+) -> list[SdImage]:
+    """Posts a generation request and returns the images of the response.
+
+    With request["send_images"] = True, the HTTP API will always return
+    the full images, base64-encoded under response["images"].
+
+    If a generation is cancelled while the webui works on it, the webui is
+    told to interrupt the job, dropping the connection alone doesn't stop it.
+    The webui interrupts whatever it is running at that moment, so this
+    only happens where that is surely this request, see owns_webui.
+
+    Args:
+        host: The webui base URL.
+        endpoint: The API path, e.g. "/sdapi/v1/txt2img".
+        request: The JSON payload.
+        debug_file: Where to dump the response JSON in debug mode.
+        timeout: Seconds the whole call may take.
+        interruptible: Whether the webui can interrupt the job, False for
+            the upscaler.
 
     Returns:
-        The downloaded image in base64 encoding with the prefix
-        "data:image/png;base64,".
+        The images in response order.
+
+    Raises:
+        BackendUnavailableError: The webui can't be reached or didn't
+            answer in time.
+    """
+
+    session = session_pool.get(host)
+    started = time.monotonic()
+    try:
+        with circuit_breaker.guard(host):
+            images = await _post_for_images(session, host, endpoint, request,
+                                            debug_file, timeout)
+    except asyncio.CancelledError:
+        if interruptible and owns_webui(host):
+            print("Request to " + host + endpoint +
+                  " cancelled, interrupting.")
+            await asyncio.shield(interface_interrupt(host))
+        raise
+
+    # Own step counts or sizes, hires fix and checkpoint switches take much
+    # longer or shorter than a regular request
+    if images and not any(key in request
+                          for key in ("steps", "width", "height",
+                                      "enable_hr", "override_settings")):
+        if "imageList" in request:
+            count = len(request["imageList"])
+        else:
+            count = request.get("batch_size", 1) * request.get("n_iter", 1)
+        latency_stats.record(host, endpoint, time.monotonic() - started,
+                             count)
+    return images
+
+
+async def _post_for_images(session: aiohttp.ClientSession, host: str,
+                           endpoint: str, request: dict, debug_file: str,
+                           timeout: float) -> list[SdImage]:
+    images = []
+
+    async with session.post(host + endpoint, json=request,
+                            timeout=client_timeout(timeout)) as response:
+        if response.status in (502, 503, 504):
+            # A proxy in front of a webui that is down
+            response.raise_for_status()
+        if response.status != 200:
+            error = await response.text()
+            if "out of memory" in error.lower():
+                raise OutOfMemoryError(error)
+            print("Request to " + host + endpoint + " failed with status " +
+                  str(response.status) + ": " + error[:500])
+            return images
+        if stream_image_responses and not debug_mode:
+            async for data in stream_images(response):
+                images.append(SdImage.from_bytes(data))
+        else:
+            response_json = await response.json()
+
+            if debug_mode:
+                with open(debug_file, "w", encoding="utf-8") as f:
+                    json.dump(response_json, f, ensure_ascii=False, indent=4)
+
+            for img in response_json["images"]:
+                images.append(SdImage.from_base64(img))
+
+    return images
+
+
+# Puts a webui call into a GPU queue, e.g. a lambda around
+# elrond_scheduler.Scheduler.run. Gets the call and returns its result
+GpuQueue = Callable[[Callable[[], Awaitable[Any]]], Awaitable[Any]]
+
+
+async def run_queued(queue: GpuQueue | None,
+                     call: Callable[[], Awaitable[Any]]) -> Any:
+    """Runs call() through the queue, or right away if there is none.
+
+    Only the webui request itself goes through the queue. Cache lookups,
+    downloads and de-duplication happen before, so a cache hit or a
+    request that joins an identical one never waits for a GPU slot.
     """
 
-    image_data = ""
+    if queue is None:
+        return await call()
+    return await queue(call)
+
+
+async def generate_images(
+        host: str,
+        endpoint: str,
+        request: dict,
+        quantity: int,
+        batch_size: int | None,
+        debug_file: str,
+        key_overrides: dict | None = None,
+        queue: GpuQueue | None = None
+) -> list[SdImage]:
+    """Runs a txt2img/img2img request with a planned batch split.
+
+    The split comes from batch_planner. If the webui runs out of memory,
+    the batch size is lowered and the request sent again.
+
+    Args:
+        host: The webui base URL.
+        endpoint: The API path, e.g. "/sdapi/v1/txt2img".
+        request: The JSON payload, batch_size and n_iter are filled in here.
+        quantity: Total number of images.
+        batch_size: Preferred batch size, None lets the planner decide.
+        debug_file: Where to dump the response JSON in debug mode.
+        key_overrides: Replacements for large request fields (images) when
+            computing the de-duplication key.
+        queue: Where the webui call waits for its GPU slot, see run_queued.
+
+    Returns:
+        The images in response order, empty if generation failed.
+    """
 
-    async with aiohttp.ClientSession() as session:
+    while True:
+        request["batch_size"], request["n_iter"] = batch_planner.plan(
+            host, quantity, batch_size)
+        # Identical requests in flight at the same time (double clicks,
+        # several people pressing a button with a fixed seed) are only
+        # computed once
+        key = request_key(host + endpoint,
+                          {**request, **(key_overrides or {})})
         try:
-            async with session.get(img_url) as resp:
-                if resp.status == 200:
-                    file = await resp.read()
-                    image_data = ("data:image/png;base64," +
-                                  str(base64.b64encode(file).decode("utf-8")))
-        except Exception as e:
-            print("Download of " + img_url + " failed: " + str(e))
+            images = await single_flight.do(
+                key, lambda: run_queued(
+                    queue, lambda: post_for_images(host, endpoint,
+                                                   dict(request), debug_file)))
+        except OutOfMemoryError:
+            if request["batch_size"] == 1:
+                print("Out of memory on " + host + " even without batching")
+                return []
+            batch_planner.record_oom(host, request["batch_size"])
+            continue
+        # Every caller gets its own list, draw_image modifies it
+        return list(images)
+
+
+async def download_image_from_url(img_url: str) -> SdImage | None:
+    """Takes any URL and downloads the image from there, returns image data.
+
+    Args:
+        img_url: The URL to the image.
+
+    Returns:
+        The downloaded image, or None if the download failed.
+    """
 
-    # image_data = "data:image/png;base64,ABC..."
-    return image_data
+    # Redraws, retries, interrogations and upscales of one source image
+    # all start here, serve repeats from the cache
+    image = download_cache.get(img_url)
+    if image is not None:
+        if debug_mode:
+            print("Download cache hit for " + img_url + " (" +
+                  str(download_cache.hits) + " hits, " +
+                  str(download_cache.misses) + " misses)")
+        return image
+
+    try:
+        image = await retry(lambda: _download(img_url))
+    except Exception as e:
+        print("Download of " + img_url + " failed: " + str(e))
+    if image is not None:
+        download_cache.put(img_url, image)
+
+    return image
+
+
+async def _download(img_url: str) -> SdImage | None:
+    session = session_pool.get(img_url)
+    async with session.get(img_url,
+                           timeout=client_timeout(download_timeout)) as resp:
+        if resp.status >= 500:
+            # Worth another try
+            resp.raise_for_status()
+        if resp.status != 200:
+            return None
+        return SdImage.from_bytes(await resp.read())
 
 
 async def interface_img_interrogate(
-        image_data: str,
-        model: str = "clip"
+        image: SdImage,
+        model: str = "clip",
+        queue: GpuQueue | None = None
 ) -> str:
     """ Check image, generate text
 
     Args:
-        image_data: The input image in base64 encoding inluding the prefix
-            ("data:image/png;base64").
+        image: The input image.
         model: Interrogation model to use. "clip" for descriptive text,
             "deepdanbooru" für tags.
+        queue: Where the webui call waits for its GPU slot, see run_queued.
 
     Returns:
         The descriptive text resulting from the image interrogation.
     """
 
+    # Same picture, same model, same caption. No need to ask the GPU again
+    image_description = interrogate_cache.get(image.sha256, model)
+    if image_description is not None:
+        print("Interrogation cache hit.")
+        return image_description
+
     print("Interrogating.")
     host = config["GRADIO_API_BASE_URL"]
 
     request = {
-        "image": image_data,
+        "image": image.base64,
         "model": model,
     }
-    image_description = None
+    # Several people clicking "Generate tags" on one picture at once share
+    # a single GPU run
+    key = request_key(host + "/sdapi/v1/interrogate",
+                      {**request, "image": image.sha256})
+    image_description = await single_flight.do(
+        key, lambda: run_queued(queue, lambda: _post_interrogate(host, request)))
+    interrogate_cache.put(image.sha256, model, image_description)
 
-    async with aiohttp.ClientSession() as session:
-        async with (session.post(host + "/sdapi/v1/interrogate", json=request)
-                    as response):
-            response_json = await response.json()
+    return image_description
 
-            if debug_mode:
-                with open(".debug.interrogate_image.json", "w",
-                          encoding="utf-8") as f:
-                    json.dump(response_json, f, ensure_ascii=False, indent=4)
 
-            image_description = response_json["caption"]
+async def _post_interrogate(host: str, request: dict) -> str:
+    with circuit_breaker.guard(host):
+        started = time.monotonic()
+        caption = await retry(lambda: _request_caption(host, request))
+    latency_stats.record(host, "/sdapi/v1/interrogate",
+                         time.monotonic() - started)
+    return caption
 
-    return image_description
+
+async def _request_caption(host: str, request: dict) -> str:
+    session = session_pool.get(host)
+    async with session.post(host + "/sdapi/v1/interrogate", json=request,
+                            timeout=client_timeout(interrogate_timeout)
+                            ) as response:
+        if response.status >= 500:
+            response.raise_for_status()
+        response_json = await response.json()
+
+        if debug_mode:
+            with open(".debug.interrogate_image.json", "w",
+                      encoding="utf-8") as f:
+                json.dump(response_json, f, ensure_ascii=False, indent=4)
+
+        return response_json["caption"]
 
 
 async def interface_interrogate_url(
         img_url: str,
-        model: str = "clip"
+        model: str = "clip",
+        queue: GpuQueue | None = None
 ) -> str | None:
     """Returns interrogation description of an image specified by URL.
 
@@ -88,43 +715,50 @@ async def interface_interrogate_url(
         img_url: The URL pointing to the image to be interrogated.
         model: Interrogation model to use. "clip" for descriptive text,
             "deepdanbooru" für tags.
+        queue: Where the webui call waits for its GPU slot, see run_queued.
+            The download doesn't wait for it.
 
     Returns:
         The descriptive text resulting from the image interrogation.
     """
 
     print("Downloading " + img_url)
-    image_data = await download_image_from_url(img_url)
+    image = await download_image_from_url(img_url)
 
-    if image_data != "":
-        return await interface_img_interrogate(image_data, model)
+    if image is not None:
+        return await interface_img_interrogate(image, model, queue)
     else:
         return None
 
 
 async def interface_upscale_image(
-        encoded_image: str,
+        image: SdImage,
         size: int = 2,
-        upscaler: str = "SwinIR_4x"
-) -> str:
+        upscaler: str = "SwinIR_4x",
+        queue: GpuQueue | None = None
+) -> SdImage | None:
     """Returns upscaled version of a given image.
 
-    Upscales the image given in base64 encoding using the given upscaler
-    with the given size factor, returning the upscaled image encoded
-    in base64.
+    Upscales the given image using the given upscaler with the given size
+    factor.
 
     Args:
-        encoded_image: The input image in base64 encoding inluding the prefix
-            ("data:image/png;base64").
+        image: The input image.
         size: The factor by which to upscale the image's dimensions.
         upscaler: The upscaling algorithm to use. Must be supported by
             the machine hosting the AI model.
+        queue: Where the webui call waits for its GPU slot, see run_queued.
 
     Returns:
-        The upscaled image in base64 encoding with the prefix
-        "data:image/png;base64,".
+        The upscaled image, None if the webui refused it.
     """
 
+    # Already upscaled this exact image the same way? Serve it from disk
+    upscaled_image = upscale_cache.get(image.sha256, size, upscaler)
+    if upscaled_image is not None:
+        print("Upscale cache hit.")
+        return upscaled_image
+
     host = config["GRADIO_API_BASE_URL"]
     print("interface upscale_image to " +
           str(size) + " with upscaler: " + upscaler)
@@ -145,25 +779,133 @@ async def interface_upscale_image(
         # "upscaler_2": "None",
         # "extras_upscaler_2_visibility": 0,
         # "upscale_first": false,
-        "image": encoded_image
+        "image": image.base64
     }
 
-    image_data = ""
+    key = request_key(host + "/sdapi/v1/extra-single-image",
+                      {**request, "image": image.sha256})
+    upscaled_image = await single_flight.do(
+        key, lambda: run_queued(queue, lambda: _post_upscale(host, request)))
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(host + "/sdapi/v1/extra-single-image",
-                                json=request) as response:
-            response_json = await response.json()
+    if upscaled_image is not None:
+        upscale_cache.put(image.sha256, size, upscaler, upscaled_image)
 
-            if debug_mode:
-                with (open(".debug.upscale_image.json", "w", encoding="utf-8")
-                      as f):
-                    json.dump(response_json, f, ensure_ascii=False, indent=4)
+    return upscaled_image
+
+
+async def interface_upscale_images(
+        images: list[SdImage],
+        size: int = 2,
+        upscaler: str = "SwinIR_4x",
+        queue: GpuQueue | None = None
+) -> list[SdImage | None]:
+    """Returns upscaled versions of several images in one round trip.
+
+    Images already in the upscale cache are served from there, the rest
+    are sent together to the webui's batch endpoint. Should that fail
+    (e.g. an older webui without it, or the batch didn't fit into VRAM),
+    they are upscaled one by one in parallel instead.
+
+    Args:
+        images: The input images.
+        size: The factor by which to upscale the image's dimensions.
+        upscaler: The upscaling algorithm to use. Must be supported by
+            the machine hosting the AI model.
+        queue: Where the webui calls wait for their GPU slot, see
+            run_queued.
+
+    Returns:
+        The upscaled images in input order, None where upscaling failed.
+    """
+
+    upscaled_images = [upscale_cache.get(image.sha256, size, upscaler)
+                       for image in images]
+    missing = [i for i, image in enumerate(upscaled_images) if image is None]
+    if not missing:
+        print("Upscale cache hit.")
+        return upscaled_images
+
+    host = config["GRADIO_API_BASE_URL"]
+    print("interface upscale_images: " + str(len(missing)) + " images to " +
+          str(size) + " with upscaler: " + upscaler)
+
+    request = {
+        "upscaling_resize": size,
+        "upscaler_1": upscaler,
+        "imageList": [{"data": images[i].base64, "name": str(i) + ".png"}
+                      for i in missing]
+    }
+    key = request_key(host + "/sdapi/v1/extra-batch-images",
+                      {**request, "imageList": [images[i].sha256
+                                                for i in missing]})
+    try:
+        results = await single_flight.do(
+            key, lambda: run_queued(
+                queue, lambda: post_for_images(host, "/sdapi/v1/extra-batch-images",
+                                               request, ".debug.upscale_images.json",
+                                               upscale_timeout, interruptible=False)))
+    except BackendUnavailableError:
+        # Single upscales wouldn't get through either
+        raise
+    except Exception as e:
+        print("Batch upscale failed: " + str(e))
+        results = []
+
+    if len(results) == len(missing):
+        for i, upscaled_image in zip(missing, results):
+            upscale_cache.put(images[i].sha256, size, upscaler, upscaled_image)
+            upscaled_images[i] = upscaled_image
+    else:
+        print("Batch upscale failed, upscaling images one by one.")
+        results = await asyncio.gather(
+            *[interface_upscale_image(images[i], size, upscaler, queue)
+              for i in missing], return_exceptions=True)
+        for i, upscaled_image in zip(missing, results):
+            if isinstance(upscaled_image, SdImage):
+                upscaled_images[i] = upscaled_image
 
-            image_data = "data:image/png;base64," + response_json["image"]
+    return upscaled_images
 
-    # image_data = "data:image/png;base64,ABC..."
-    return image_data
+
+async def _post_upscale(host: str, request: dict) -> SdImage | None:
+    upscaled_image = None
+
+    session = session_pool.get(host)
+    started = time.monotonic()
+    with circuit_breaker.guard(host):
+        async with session.post(host + "/sdapi/v1/extra-single-image",
+                                json=request,
+                                timeout=client_timeout(upscale_timeout)
+                                ) as response:
+            if response.status in (502, 503, 504):
+                # A proxy in front of a webui that is down
+                response.raise_for_status()
+            if response.status != 200:
+                # E.g. an unknown upscaler
+                error = await response.text()
+                print("Upscale on " + host + " failed with status " +
+                      str(response.status) + ": " + error[:500])
+                return None
+            if stream_image_responses and not debug_mode:
+                async for data in stream_images(response, "image"):
+                    upscaled_image = SdImage.from_bytes(data)
+            else:
+                response_json = await response.json()
+
+                if debug_mode:
+                    with (open(".debug.upscale_image.json", "w",
+                               encoding="utf-8") as f):
+                        json.dump(response_json, f, ensure_ascii=False,
+                                  indent=4)
+
+                if response_json.get("image"):
+                    upscaled_image = SdImage.from_base64(
+                        response_json["image"])
+
+    if upscaled_image is not None:
+        latency_stats.record(host, "/sdapi/v1/extra-single-image",
+                             time.monotonic() - started)
+    return upscaled_image
 
 
 async def interface_txt2img(
@@ -172,8 +914,18 @@ async def interface_txt2img(
         quantity: int = 1,
         negative_prompt: str = "",
         simulate_nai: bool = True,
-        host: str | None = None
-) -> list[str]:
+        host: str | None = None,
+        batch_size: int | None = None,
+        hires_scale: float = 1,
+        hires_upscaler: str = "Latent",
+        hires_denoising_strength: float = 0.5,
+        steps: int | None = None,
+        width: int | None = None,
+        height: int | None = None,
+        checkpoint: str | None = None,
+        keep_checkpoint: bool = False,
+        queue: GpuQueue | None = None
+) -> list[SdImage]:
     """Returns images based on the text prompt given.
 
     The prompt and seed are forwarded to the AI model via the API
@@ -197,10 +949,28 @@ async def interface_txt2img(
             will be used to have that machine create the images. If no
             host is specified, the default value from the config file will
             be used.
+        batch_size: How many of the `quantity` images the GPU should render
+            in parallel. None lets the batch planner decide based on the
+            backend's VRAM profile, the planner may also lower it. Image i
+            always gets seed + i, no matter how the images are split.
+        hires_scale: If above 1, the webui's hires fix renders the images
+            this much bigger in the same call, so no separate upscale
+            round trip is needed.
+        hires_upscaler: The upscaler the hires fix uses between its passes.
+        hires_denoising_strength: How much the hires pass may change the
+            upscaled image.
+        steps: Sampling steps, None uses the webui's default. Few steps
+            make a fast but rough picture, e.g. a draft.
+        width: Image width in pixels, None uses the webui's default.
+        height: Image height in pixels, None uses the webui's default.
+        checkpoint: The model to draw with, None keeps the loaded one.
+        keep_checkpoint: Leave the model loaded afterwards, see
+            set_checkpoint.
+        queue: Where the webui call waits for its GPU slot, see run_queued.
 
     Returns:
-        A list of strings containing base64-encoded representations of the
-        images, each prefixed with the substring "data:image/png;base64,".
+        A list of the generated images. If more than one image was generated,
+        the webui puts a grid of all images in front.
 
     TODO:
         * Unify parameter handling/defaults (empty string vs. None vs.
@@ -247,8 +1017,7 @@ async def interface_txt2img(
         "seed": seed,
         "sampler_name": config["SAMPLING_METHOD_TXT2IMG"],
         "negative_prompt": negative_prompt,
-        "batch_size": 1,
-        "n_iter": quantity,
+        # "batch_size" and "n_iter" are planned in generate_images
         "script_args": script_args,
         "script_name": script_name,
         "do_not_save_grid": False,
@@ -290,33 +1059,29 @@ async def interface_txt2img(
         # "override_settings_restore_afterwards": true,
         # "alwayson_scripts": {}
     }
-    images = []
 
-    async with aiohttp.ClientSession() as session:
-        if host is None:
-            host = config["GRADIO_API_BASE_URL"]
-
-        # With request["send_images"] = True, the HTTP API will always return
-        # the full images, base64-encoded under response["images"]
-        async with (session.post(host + "/sdapi/v1/txt2img", json=request)
-                    as response):
-            response_json = await response.json()
-
-            if debug_mode:
-                with open(".debug.txt2img_response.json", "w",
-                          encoding="utf-8") as f:
-                    json.dump(response_json, f, ensure_ascii=False, indent=4)
+    # Hires fix: the webui upscales between two sampling passes and sends
+    # back the big picture directly
+    if hires_scale > 1:
+        request["enable_hr"] = True
+        request["hr_scale"] = hires_scale
+        request["hr_upscaler"] = hires_upscaler
+        request["denoising_strength"] = hires_denoising_strength
+
+    if steps is not None:
+        request["steps"] = steps
+    if width is not None:
+        request["width"] = width
+    if height is not None:
+        request["height"] = height
+    set_checkpoint(request, checkpoint, keep_checkpoint)
 
-            for img in response_json["images"]:
-                images.append("data:image/png;base64," + img)
+    if host is None:
+        host = config["GRADIO_API_BASE_URL"]
 
-    """images =  [
-        "data:image/png;base64,ABC...",
-        "data:image/png;base64,ABC...",
-        ...
-    ]
-    """
-    return images
+    return await generate_images(host, "/sdapi/v1/txt2img", request,
+                                 quantity, batch_size,
+                                 ".debug.txt2img_response.json", queue=queue)
 
 
 async def interface_img2img(
@@ -325,10 +1090,13 @@ async def interface_img2img(
         quantity: int = 1,
         negative_prompt: str = "",
         simulate_nai: bool = True,
-        img2img_image_data: str = "",
+        img2img_image: SdImage | None = None,
         denoising_strength: float = 0.6,
-        host: str = None
-) -> list[str]:
+        host: str = None,
+        checkpoint: str | None = None,
+        keep_checkpoint: bool = False,
+        queue: GpuQueue | None = None
+) -> list[SdImage]:
     """Returns images based on the input image given.
 
     The input image, prompt and seed are forwarded to the AI model
@@ -348,17 +1116,20 @@ async def interface_img2img(
         simulate_nai: If True, will complete user-given (negative) prompts
             with additional (negative) prompt strings used by the nai
             model checkpoint.
-        img2img_image_data: The input image in base64 encoding inluding the
-            prefix ("data:image/png;base64").
+        img2img_image: The input image.
         denoising_strength: The denoising factor.
         host: The machine that hosts the Stable Diffusion WebUI-API which
             will be used to have that machine create the images. If no
             host is specified, the default value from the config file will
             be used.
+        checkpoint: The model to draw with, None keeps the loaded one.
+        keep_checkpoint: Leave the model loaded afterwards, see
+            set_checkpoint.
+        queue: Where the webui call waits for its GPU slot, see run_queued.
 
     Returns:
-        A list of strings containing base64-encoded representations of the
-        images, each prefixed with the substring "data:image/png;base64,".
+        A list of the generated images. If more than one image was generated,
+        the webui puts a grid of all images in front.
 
     TODO:
         * Unify parameter handling/defaults (empty string vs. None vs.
@@ -405,7 +1176,7 @@ async def interface_img2img(
     # TODO: saner defaults - from config?
     request = {
         "init_images": [
-            img2img_image_data
+            img2img_image.base64
         ],
         # "resize_mode": 0,
         "denoising_strength": denoising_strength,
@@ -427,8 +1198,7 @@ async def interface_img2img(
         # "seed_resize_from_h": -1,
         # "seed_resize_from_w": -1,
         "sampler_name": sampling_method_img2img,
-        "batch_size": 1,
-        "n_iter": quantity,
+        # "batch_size" and "n_iter" are planned in generate_images
         # "steps": 50,
         # "cfg_scale": 7,
         # "width": 512,
@@ -453,26 +1223,157 @@ async def interface_img2img(
         "save_images": True, # Needed for multi image grid feature (quantity < 4)
         # "alwayson_scripts": {}
     }
+    set_checkpoint(request, checkpoint, keep_checkpoint)
 
-    images = []
+    return await generate_images(
+        host, "/sdapi/v1/img2img", request, quantity, None,
+        ".debug.img2img_response.json",
+        key_overrides={"init_images": [img2img_image.sha256]}, queue=queue)
 
-    async with aiohttp.ClientSession() as session:
-        async with (session.post(host + "/sdapi/v1/img2img", json=request) 
-                    as response):
-            response_json = await response.json()
 
-            if debug_mode:
-                with open(".debug.img2img_response.json", "w",
-                          encoding="utf-8") as f:
-                    json.dump(response_json, f, ensure_ascii=False, indent=4)
+async def interface_progress(
+        host: str = None,
+        current_image: bool = False
+) -> dict | None:
+    """Returns how far the webui is with the job it is working on.
 
-            for img in response_json["images"]:
-                images.append("data:image/png;base64," + img)
+    Args:
+        host: The machine that hosts the Stable Diffusion WebUI-API. If no
+            host is specified, the default value from the config file will
+            be used.
+        current_image: If True, the webui also renders a low resolution
+            preview of the unfinished picture. Costs GPU time, only ask for
+            it when it is shown.
 
-    """images =  [
-        "data:image/png;base64,ABC...",
-        "data:image/png;base64,ABC...",
-        ...
-    ]
+    Returns:
+        The webui's progress info with "progress" (0 to 1), "eta_relative"
+        (seconds), "state" (job and step counters) and, if requested,
+        "current_image" as SdImage or None. None if the webui didn't answer.
     """
-    return images
+
+    if host is None:
+        host = config["GRADIO_API_BASE_URL"]
+
+    session = session_pool.get(host)
+    params = {"skip_current_image": "false" if current_image else "true"}
+    try:
+        async with session.get(host + "/sdapi/v1/progress", params=params,
+                               timeout=client_timeout(status_timeout)
+                               ) as response:
+            if response.status != 200:
+                return None
+            progress = await response.json()
+    except Exception as e:
+        if debug_mode:
+            print("Progress of " + host + " unavailable: " + str(e))
+        return None
+
+    if progress.get("current_image"):
+        progress["current_image"] = SdImage.from_base64(
+            progress["current_image"])
+    else:
+        progress["current_image"] = None
+    return progress
+
+
+async def interface_interrupt(host: str = None) -> bool:
+    """Stops whatever the webui is drawing right now.
+
+    The webui finishes the current sampling step and skips the rest of
+    the job, including further batches of it.
+
+    Args:
+        host: The machine that hosts the Stable Diffusion WebUI-API. If no
+            host is specified, the default value from the config file will
+            be used.
+
+    Returns:
+        True if the webui accepted the interrupt.
+    """
+
+    if host is None:
+        host = config["GRADIO_API_BASE_URL"]
+
+    session = session_pool.get(host)
+    try:
+        async with session.post(host + "/sdapi/v1/interrupt",
+                                timeout=client_timeout(status_timeout)
+                                ) as response:
+            return response.status == 200
+    except Exception as e:
+        print("Interrupting " + host + " failed: " + str(e))
+        return False
+
+
+async def wait_for_webui(host: str = None, interval: float = 5) -> None:
+    """Returns once the webui's API answers.
+
+    Args:
+        host: The machine that hosts the Stable Diffusion WebUI-API. If no
+            host is specified, the default value from the config file will
+            be used.
+        interval: Seconds between two attempts.
+    """
+
+    if host is None:
+        host = config["GRADIO_API_BASE_URL"]
+
+    while await interface_progress(host) is None:
+        await asyncio.sleep(interval)
+
+
+async def interface_warm_up(host: str = None,
+                            upscaler: str = "None") -> None:
+    """Gets the webui going and measures how fast it is.
+
+    The first calls after a webui start are much slower than the rest, the
+    models are loaded onto the GPU and kernels compiled. A tiny txt2img,
+    an interrogation and an upscale take care of that, then one regular
+    txt2img, interrogation and upscale give first latency_stats numbers.
+    The caches are bypassed.
+
+    Args:
+        host: The machine that hosts the Stable Diffusion WebUI-API. If no
+            host is specified, the default value from the config file will
+            be used.
+        upscaler: The upscaler to load.
+
+    Raises:
+        Whatever went wrong, the webui may still be usable.
+    """
+
+    if host is None:
+        host = config["GRADIO_API_BASE_URL"]
+
+    request = {
+        "prompt": "a lighthouse at dawn",
+        "seed": 1,
+        "sampler_name": config["SAMPLING_METHOD_TXT2IMG"],
+        "batch_size": 1,
+        "n_iter": 1,
+        "send_images": True,
+        "save_images": False,
+        "do_not_save_grid": True,
+    }
+    for calibrate in [False, True]:
+        started = time.monotonic()
+        txt2img_request = dict(request)
+        if not calibrate:
+            # As small and short as it gets, only there to load everything
+            txt2img_request.update({"steps": 2, "width": 64, "height": 64})
+        images = await post_for_images(host, "/sdapi/v1/txt2img",
+                                       txt2img_request,
+                                       ".debug.warm_up_response.json")
+        if not images:
+            raise RuntimeError("Warm-up txt2img on " + host +
+                               " returned no image")
+        await _post_interrogate(host, {"image": images[0].base64,
+                                       "model": "clip"})
+        await _post_upscale(host, {"upscaling_resize": 2,
+                                   "upscaler_1": upscaler,
+                                   "image": images[0].base64})
+        if not calibrate:
+            # Cold start numbers say nothing about later calls
+            latency_stats.forget(host)
+        print(("Calibrated " if calibrate else "Warmed up ") + host + " in " +
+              str(round(time.monotonic() - started, 1)) + " seconds")
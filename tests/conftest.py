@@ -0,0 +1,31 @@
+import os
+import sys
+
+import dotenv
+
+# The bot's modules sit in the repository root
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+_dotenv_values = dotenv.dotenv_values
+
+
+def dotenv_values(dotenv_path=None, **kwargs):
+    """The repository's .env, wherever the tests are started from.
+
+    Caches and registries that would live in files are turned off, importing
+    a module must not leave anything behind in the checkout. Tests that need
+    them create their own under tmp_path.
+    """
+    if dotenv_path != ".env":
+        return _dotenv_values(dotenv_path, **kwargs)
+    config = _dotenv_values(os.path.join(root, ".env"), **kwargs)
+    config["INTERROGATE_CACHE_DB"] = ""
+    config["UPSCALE_CACHE_MB"] = "0"
+    config["HIVE_DB"] = ""
+    return config
+
+
+# The modules read their config when they are imported, which happens after
+# this file was loaded
+dotenv.dotenv_values = dotenv_values
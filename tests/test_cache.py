@@ -0,0 +1,216 @@
+import asyncio
+import time
+
+import pytest
+
+from elrond_cache import (DownloadCache, InterrogationCache, SingleFlight,
+                          UpscaleCache, discord_link_expiry, normalize_url)
+from elrond_image import SdImage
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Fakes time.time and time.monotonic, both only move when told to."""
+    class Clock():
+        now = 1700000000.0
+
+        def advance(self, seconds):
+            self.now += seconds
+
+    clock = Clock()
+    monkeypatch.setattr(time, "time", lambda: clock.now)
+    monkeypatch.setattr(time, "monotonic", lambda: clock.now)
+    return clock
+
+
+def cdn_link(name: str, expires: float) -> str:
+    return ("https://cdn.discordapp.com/attachments/1/2/" + name +
+            "?ex=" + format(int(expires), "x") + "&is=65e0&hm=abc")
+
+
+def test_normalize_discord_links():
+    signed = ("https://CDN.discordapp.com/attachments/1/2/cat.png"
+              "?hm=abc&ex=65f0&is=65e0&width=100")
+    assert normalize_url(signed) == \
+        "https://cdn.discordapp.com/attachments/1/2/cat.png?width=100"
+    # Elsewhere the same parameters may pick a different file
+    other = "https://example.com/image?is=2&hm=1"
+    assert normalize_url(other) == "https://example.com/image?hm=1&is=2"
+
+
+def test_discord_link_expiry():
+    assert discord_link_expiry(cdn_link("cat.png", 1700000600)) == 1700000600
+    assert discord_link_expiry("https://example.com/cat.png?ex=65f0") is None
+    assert discord_link_expiry(
+        "https://cdn.discordapp.com/cat.png?ex=nothex") is None
+    assert discord_link_expiry("https://cdn.discordapp.com/cat.png") is None
+
+
+def test_download_cache_shares_content():
+    cache = DownloadCache(max_bytes=10, ttl=60)
+    image = SdImage.from_bytes(b"12345")
+    cache.put("https://example.com/a.png", image)
+    cache.put("https://example.com/b.png", SdImage.from_bytes(b"12345"))
+    assert cache.size == 5
+    assert cache.get("https://EXAMPLE.com/a.png") is image
+    # Over budget, the least recently used URL goes
+    cache.put("https://example.com/c.png", SdImage.from_bytes(b"6789012"))
+    assert cache.get("https://example.com/b.png") is None
+    assert cache.get("https://example.com/a.png") is None
+    assert cache.get("https://example.com/c.png") is not None
+
+
+def test_download_cache_ttl(clock):
+    cache = DownloadCache(max_bytes=100, ttl=60)
+    cache.put("https://example.com/a.png", SdImage.from_bytes(b"12345"))
+    clock.advance(59)
+    assert cache.get("https://example.com/a.png") is not None
+    clock.advance(1)
+    assert cache.get("https://example.com/a.png") is None
+    assert cache.size == 0
+
+
+def test_download_cache_discord_link_expiry(clock):
+    cache = DownloadCache(max_bytes=100, ttl=3600)
+    # The link dies long before the ttl is up
+    link = cdn_link("cat.png", clock.now + 10)
+    cache.put(link, SdImage.from_bytes(b"12345"))
+    # A refreshed link of the same attachment finds it
+    assert cache.get(cdn_link("cat.png", clock.now + 7200)) is not None
+    clock.advance(10)
+    assert cache.get(link) is None
+
+
+def test_download_cache_skips_expired_links(clock):
+    cache = DownloadCache(max_bytes=100, ttl=3600)
+    cache.put(cdn_link("cat.png", clock.now - 1), SdImage.from_bytes(b"12345"))
+    assert cache.size == 0
+
+
+def test_interrogation_cache_in_memory():
+    cache = InterrogationCache(max_entries=2)
+    cache.put("a", "clip", "a cat")
+    cache.put("a", "deepdanbooru", "cat, solo")
+    assert cache.get("a", "clip") == "a cat"
+    # The least recently used caption goes first
+    cache.put("b", "clip", "a dog")
+    assert cache.get("a", "deepdanbooru") is None
+    assert cache.get("a", "clip") == "a cat"
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_interrogation_cache_survives_restarts(tmp_path):
+    db_path = str(tmp_path / "interrogations.sqlite3")
+    cache = InterrogationCache(max_entries=1, db_path=db_path)
+    cache.put("a", "clip", "a cat")
+    cache.put("b", "clip", "a dog")
+    # Dropped from memory, but still on disk
+    assert cache.get("a", "clip") == "a cat"
+
+    restarted = InterrogationCache(max_entries=1, db_path=db_path)
+    assert restarted.get("b", "clip") == "a dog"
+    assert restarted.get("b", "deepdanbooru") is None
+
+
+def test_upscale_cache(tmp_path):
+    cache = UpscaleCache(str(tmp_path), max_bytes=100)
+    cache.put("digest", 2, "ESRGAN", SdImage.from_bytes(b"upscaled"))
+    assert cache.get("digest", 2, "ESRGAN").data == b"upscaled"
+    assert cache.get("digest", 4, "ESRGAN") is None
+    # Picked up again after a restart
+    assert UpscaleCache(str(tmp_path), 100).get(
+        "digest", 2, "ESRGAN").data == b"upscaled"
+
+
+def test_upscale_cache_evicts_least_recently_used(tmp_path):
+    cache = UpscaleCache(str(tmp_path), max_bytes=20)
+    cache.put("a", 2, "ESRGAN", SdImage.from_bytes(b"0123456789"))
+    cache.put("b", 2, "ESRGAN", SdImage.from_bytes(b"0123456789"))
+    cache.get("a", 2, "ESRGAN")
+    cache.put("c", 2, "ESRGAN", SdImage.from_bytes(b"0123456789"))
+    assert cache.get("b", 2, "ESRGAN") is None
+    assert cache.get("a", 2, "ESRGAN") is not None
+    assert cache.size == 20
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_upscale_cache_file_deleted_behind_its_back(tmp_path):
+    cache = UpscaleCache(str(tmp_path), max_bytes=100)
+    cache.put("digest", 2, "ESRGAN", SdImage.from_bytes(b"upscaled"))
+    for path in tmp_path.iterdir():
+        path.unlink()
+    assert cache.get("digest", 2, "ESRGAN") is None
+    assert cache.size == 0
+
+
+def test_upscale_cache_write_failure(tmp_path):
+    cache = UpscaleCache(str(tmp_path), max_bytes=100)
+    cache.directory = str(tmp_path / "missing")
+    cache.put("digest", 2, "ESRGAN", SdImage.from_bytes(b"upscaled"))
+    assert cache.size == 0
+    assert cache.get("digest", 2, "ESRGAN") is None
+
+
+def test_single_flight_shares_call():
+    async def main():
+        flight = SingleFlight()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "result"
+
+        results = await asyncio.gather(*[flight.do("key", call)
+                                         for _ in range(3)])
+        assert results == ["result"] * 3
+        await flight.do("key", call)
+        return calls
+    # Later callers start a new call
+    assert asyncio.run(main()) == [1, 1]
+
+
+def test_single_flight_waiters():
+    async def main():
+        flight = SingleFlight()
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def call():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        first = asyncio.ensure_future(flight.do("key", call))
+        second = asyncio.ensure_future(flight.do("key", call))
+        await started.wait()
+        first.cancel()
+        await asyncio.sleep(0.01)
+        # Somebody still waits for it
+        assert not cancelled.is_set() and not second.done()
+        second.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        assert flight._calls == {} and flight._waiters == {}
+    asyncio.run(main())
+
+
+def test_single_flight_shares_exceptions():
+    async def main():
+        flight = SingleFlight()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise ValueError("broken")
+
+        results = await asyncio.gather(*[flight.do("key", call)
+                                         for _ in range(2)],
+                                       return_exceptions=True)
+        return calls, results
+    calls, results = asyncio.run(main())
+    assert calls == [1]
+    assert [type(result) for result in results] == [ValueError, ValueError]
@@ -0,0 +1,294 @@
+import asyncio
+import random
+from datetime import timedelta
+
+import pytest
+from aiohttp import web
+
+import elrond_hive
+from elrond_hive import Hive, HiveBot, HiveRegistry, HiveRouter
+from elrond_sd_interface import LatencyStats, session_pool
+
+
+@pytest.fixture(autouse=True)
+def latencies(monkeypatch):
+    """Fresh latency measurements for every test."""
+    latency_stats = LatencyStats()
+    monkeypatch.setattr(elrond_hive, "latency_stats", latency_stats)
+    return latency_stats
+
+
+async def serve(routes: list[web.RouteDef]) -> tuple[web.AppRunner, str]:
+    """Starts a fake webui on a free port, returns it and its URL."""
+    app = web.Application()
+    app.add_routes(routes)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner, "http://127.0.0.1:" + str(runner.addresses[0][1])
+
+
+def progress_route(state: dict) -> web.RouteDef:
+    async def progress(request):
+        return web.json_response({"progress": 0, "state": state})
+    return web.get("/sdapi/v1/progress", progress)
+
+
+def make_hive() -> Hive:
+    # Without the Discord client, which only the commands need
+    hive = object.__new__(Hive)
+    Hive.__init__(hive, None)
+    return hive
+
+
+def hivebot(name: str, load: int = 0, latency: float | None = None,
+            latencies: LatencyStats | None = None) -> HiveBot:
+    machine = HiveBot("http://" + name, nickname=name)
+    machine.in_flight = load
+    if latency is not None:
+        latencies.record(machine.url, "/sdapi/v1/txt2img", latency)
+    return machine
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        HiveRouter("fastest")
+
+
+def test_no_machines():
+    assert HiveRouter("p2c").choose([]) is None
+
+
+def test_least_outstanding():
+    machines = [hivebot("a", load=2), hivebot("b", load=0),
+                hivebot("c", load=1)]
+    assert HiveRouter("least_outstanding").choose(machines).nickname == "b"
+
+
+def test_ewma(latencies):
+    machines = [hivebot("slow", load=0, latency=10, latencies=latencies),
+                hivebot("fast", load=2, latency=2, latencies=latencies)]
+    # 1 x 10 seconds against 3 x 2 seconds
+    assert HiveRouter("ewma").choose(machines).nickname == "fast"
+
+
+def test_ewma_unknown_latency_counts_as_fastest(latencies):
+    machines = [hivebot("known", load=1, latency=2, latencies=latencies),
+                hivebot("new", load=0)]
+    assert HiveRouter("ewma").choose(machines).nickname == "new"
+
+
+def test_p2c_never_picks_the_worst(latencies):
+    random.seed(1)
+    machines = [hivebot(str(i), load=i, latency=1, latencies=latencies)
+                for i in range(4)]
+    router = HiveRouter("p2c")
+    chosen = {router.choose(machines).nickname for _ in range(100)}
+    # The worst machine loses against whichever it is paired with
+    assert "3" not in chosen
+    assert len(chosen) > 1
+
+
+def test_routing_refresh_does_not_count_failures(monkeypatch):
+    async def main():
+        hive = make_hive()
+        # Nothing listens there
+        machine = HiveBot("http://127.0.0.1:9", nickname="gone")
+        machine.queue_depth = 2
+        hive.add_client(machine)
+        await hive.pick_client()
+        await asyncio.sleep(0.1)
+        await session_pool.close()
+        return machine
+    monkeypatch.setattr(elrond_hive, "hive_routing", "ewma")
+    machine = asyncio.run(main())
+    assert machine.failures == 0 and machine.healthy
+    # Unknown, the last known depth still counts
+    assert machine.queue_depth == 2
+
+
+def test_probe_reads_queue_depth():
+    async def main():
+        runner, url = await serve([progress_route(
+            {"job": "task(1)", "job_count": 3, "job_no": 1})])
+        machine = HiveBot(url)
+        machine.failures = 2
+        answered = await machine.probe()
+        await session_pool.close()
+        await runner.cleanup()
+        return answered, machine
+    answered, machine = asyncio.run(main())
+    assert answered
+    assert machine.failures == 0 and machine.queue_depth == 2
+
+
+def test_probe_all_marks_unhealthy_and_evicts(monkeypatch):
+    monkeypatch.setattr(elrond_hive, "hive_unhealthy_after", 2)
+    monkeypatch.setattr(elrond_hive, "hive_evict_after", 3)
+
+    async def main():
+        runner, url = await serve([progress_route({"job": ""})])
+        hive = make_hive()
+        alive = HiveBot(url, nickname="alive")
+        gone = HiveBot("http://127.0.0.1:9", nickname="gone")
+        hive.add_client(alive)
+        hive.add_client(gone)
+        states = []
+        for _ in range(3):
+            await hive.probe_all()
+            states.append(([machine.nickname for machine in hive.hivebots],
+                           [machine.nickname
+                            for machine in hive.available_clients()]))
+        sessions = list(session_pool.sessions)
+        await session_pool.close()
+        await runner.cleanup()
+        return states, sessions, url
+    states, sessions, url = asyncio.run(main())
+    assert states == [
+        (["alive", "gone"], ["alive", "gone"]),
+        # Unhealthy: still in the hive, but no more requests
+        (["alive", "gone"], ["alive"]),
+        # Evicted, its connections closed
+        (["alive"], ["alive"]),
+    ]
+    assert sessions == [url]
+
+
+def test_probe_all_drops_expired_machines():
+    async def main():
+        runner, url = await serve([progress_route({"job": ""})])
+        hive = make_hive()
+        machine = HiveBot(url, nickname="old")
+        machine.dt_added -= timedelta(hours=elrond_hive.hive_node_ttl)
+        hive.add_client(machine)
+        await hive.probe_all()
+        await session_pool.close()
+        await runner.cleanup()
+        return hive.hivebots
+    assert asyncio.run(main()) == []
+
+
+def test_registry_round_trip(tmp_path, latencies):
+    db_path = str(tmp_path / "hive.sqlite3")
+    machine = HiveBot("http://a", "token", "a", {"checkpoint": "model"})
+    latencies.record(machine.url, "/sdapi/v1/txt2img", 4.0)
+    HiveRegistry(db_path).save([machine])
+
+    latencies.forget(machine.url)
+    restored, = HiveRegistry(db_path).load()
+    assert (restored.url, restored.access_token, restored.nickname,
+            restored.config, restored.dt_added) == \
+        ("http://a", "token", "a", {"checkpoint": "model"}, machine.dt_added)
+    assert restored.latency == 4.0
+    # Unhealthy until it answers a check again
+    assert not restored.healthy
+
+    HiveRegistry(db_path).remove(machine.url)
+    assert HiveRegistry(db_path).load() == []
+
+
+def test_hive_restores_machines(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "hive.sqlite3")
+    old = HiveBot("http://old", nickname="old")
+    old.dt_added -= timedelta(hours=elrond_hive.hive_node_ttl)
+    HiveRegistry(db_path).save([old, HiveBot("http://new", nickname="new")])
+    monkeypatch.setattr(elrond_hive, "hive_db", db_path)
+
+    hive = make_hive()
+    assert [machine.nickname for machine in hive.hivebots] == ["new"]
+    # Expired machines are gone from the file as well
+    assert [machine.nickname
+            for machine in HiveRegistry(db_path).load()] == ["new"]
+
+
+def test_hive_keeps_registry_up_to_date(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "hive.sqlite3")
+    monkeypatch.setattr(elrond_hive, "hive_db", db_path)
+
+    async def main():
+        hive = make_hive()
+        hive.add_client(HiveBot("http://a", nickname="first"))
+        hive.add_client(HiveBot("http://a", nickname="again"))
+        hive.add_client(HiveBot("http://b", nickname="b"))
+        await hive.remove_client(hive.hivebots[-1])
+    asyncio.run(main())
+    assert [machine.nickname
+            for machine in HiveRegistry(db_path).load()] == ["again"]
+
+
+def test_has_checkpoint():
+    machine = HiveBot("http://a", config={
+        "checkpoint": "anything-v3.safetensors [abc123]",
+        "checkpoint_name": "anything-v3"})
+    assert machine.has_checkpoint("Anything-V3")
+    assert machine.has_checkpoint("anything-v3.safetensors [abc123]")
+    # Only the whole name, "anything" could be another model
+    assert not machine.has_checkpoint("anything")
+    assert not HiveBot("http://b").has_checkpoint("anything-v3")
+
+    machine.set_checkpoint("realistic")
+    assert machine.has_checkpoint("realistic")
+    assert not machine.has_checkpoint("anything-v3")
+
+
+def test_prefer_checkpoint():
+    def machines(*loads):
+        # The first machine has the model loaded, the others don't
+        hivebots = [hivebot(str(i), load=load) for i, load in enumerate(loads)]
+        hivebots[0].set_checkpoint("model")
+        return hivebots
+
+    def preferred(hivebots):
+        return [machine.nickname for machine in
+                HiveRouter.prefer_checkpoint(hivebots, "model")]
+
+    assert preferred(machines(0, 0)) == ["0"]
+    assert preferred(machines(3, 1)) == ["0"]
+    # Busy, an idle machine rather loads the model
+    assert preferred(machines(1, 0, 2)) == ["1"]
+    others = machines(0, 0)[1:]
+    assert preferred(others) == ["1"]
+    assert HiveRouter("least_outstanding").choose(
+        machines(2, 0), "model").nickname == "1"
+
+
+def test_pick_client_remembers_the_switch(monkeypatch):
+    monkeypatch.setattr(elrond_hive, "hive_routing", "random")
+
+    async def main():
+        hive = make_hive()
+        hive.add_client(HiveBot("http://a", nickname="a"))
+        return await hive.pick_client("model")
+    machine = asyncio.run(main())
+    # The next request for the model goes there as well
+    assert machine.has_checkpoint("model")
+
+
+def test_refresh_checkpoint():
+    requests = []
+
+    async def options(request):
+        requests.append("options")
+        return web.json_response({"sd_model_checkpoint": "model.ckpt [abc]"})
+
+    async def models(request):
+        requests.append("sd-models")
+        return web.json_response([
+            {"title": "other.ckpt [def]", "model_name": "other"},
+            {"title": "model.ckpt [abc]", "model_name": "model"}])
+
+    async def main():
+        runner, url = await serve([web.get("/sdapi/v1/options", options),
+                                   web.get("/sdapi/v1/sd-models", models)])
+        machine = HiveBot(url, config={"checkpoint": "other.ckpt [def]",
+                                       "checkpoint_name": "other"})
+        await machine.refresh_checkpoint()
+        # Unchanged, the model list isn't asked again
+        await machine.refresh_checkpoint()
+        await session_pool.close()
+        await runner.cleanup()
+        return machine
+    machine = asyncio.run(main())
+    assert machine.config == {"checkpoint": "model.ckpt [abc]",
+                              "checkpoint_name": "model"}
+    assert requests == ["options", "sd-models", "options"]
@@ -0,0 +1,65 @@
+import base64
+import json
+import os
+
+import pytest
+
+from elrond_image import ImageStreamDecoder
+
+
+def decode(body: bytes, chunk_size: int, key: str = "images",
+           decode_block: int | None = None) -> list[bytes]:
+    decoder = ImageStreamDecoder(key)
+    if decode_block is not None:
+        decoder.decode_block = decode_block
+    images = []
+    for i in range(0, len(body), chunk_size):
+        images += decoder.feed(body[i:i + chunk_size])
+    return images
+
+
+# Random bytes, so the base64 has plenty of "/" and "+" in it
+pictures = [os.urandom(1000), os.urandom(3), os.urandom(1)]
+body = json.dumps({
+    "parameters": {"images": ["not this one"], "prompt": "a \"cat\""},
+    "images": [base64.b64encode(picture).decode() for picture in pictures],
+    "info": "{\"images\": [\"nor this\"]}",
+}).encode()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 4096, len(body)])
+def test_images_in_any_chunk_size(chunk_size):
+    assert decode(body, chunk_size) == pictures
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, len(body)])
+def test_escaped_slashes(chunk_size):
+    escaped = body.replace(b"/", b"\\/")
+    assert b"\\/" in escaped
+    assert decode(escaped, chunk_size) == pictures
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 4096])
+def test_small_decode_blocks(chunk_size):
+    assert decode(body, chunk_size, decode_block=8) == pictures
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4096])
+def test_single_image_key(chunk_size):
+    picture = os.urandom(500)
+    upscale = json.dumps({
+        "html_info": "<p>done</p>",
+        "image": base64.b64encode(picture).decode().replace("/", "\\/"),
+    }).encode()
+    assert decode(upscale, chunk_size, key="image") == [picture]
+
+
+def test_unpadded_base64():
+    picture = os.urandom(4)
+    encoded = base64.b64encode(picture).decode().rstrip("=")
+    unpadded = json.dumps({"images": [encoded]}).encode()
+    assert decode(unpadded, 1) == [picture]
+
+
+def test_no_images():
+    assert decode(b'{"images": [], "info": "nothing"}', 1) == []
@@ -0,0 +1,175 @@
+import asyncio
+import itertools
+import time
+
+import interactions
+import pytest
+
+from elrond_messages import ChannelBucket, MessageUpdater, get_channel_bucket
+
+channel_ids = itertools.count()
+
+
+class FakeMessage():
+    """Records the edits a MessageUpdater sends."""
+
+    def __init__(self) -> None:
+        # Every test gets its own channel and with it its own edit bucket
+        self.channel_id = "test-channel-" + str(next(channel_ids))
+        self.edits = []
+
+    async def edit(self, **kwargs) -> None:
+        self.edits.append((kwargs["embeds"][0].title, "files" in kwargs))
+        await asyncio.sleep(0.01)
+
+
+def embed(title: str) -> interactions.Embed:
+    return interactions.Embed(title=title)
+
+
+def test_progress_is_coalesced():
+    async def main():
+        message = FakeMessage()
+        updater = MessageUpdater(message, interval=0.1)
+        for i in range(20):
+            await updater.progress([embed(str(i))])
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.15)
+        return message.edits
+    edits = asyncio.run(main())
+    # The first state right away, then at most one every interval, and the
+    # latest state always makes it
+    assert edits[0] == ("0", False)
+    assert len(edits) <= 4
+    assert edits[-1] == ("19", False)
+
+
+def test_progress_states_are_copied():
+    async def main():
+        message = FakeMessage()
+        updater = MessageUpdater(message, interval=0.1)
+        progress = embed("queued")
+        await updater.progress([progress])
+        # The caller keeps changing its embed
+        progress.title = "changed"
+        await asyncio.sleep(0.05)
+        return message.edits
+    assert asyncio.run(main()) == [("queued", False)]
+
+
+def test_files_only_with_finish():
+    async def main():
+        message = FakeMessage()
+        updater = MessageUpdater(message, interval=0)
+        await updater.progress([embed("drawing")])
+        await asyncio.sleep(0.05)
+        await updater.finish([embed("done")], interactions.MISSING,
+                             files=[interactions.File(filename="1.png",
+                                                      fp=b"png")])
+        return message.edits
+    assert asyncio.run(main()) == [("drawing", False), ("done", True)]
+
+
+def test_finish_drops_pending_progress():
+    async def main():
+        message = FakeMessage()
+        updater = MessageUpdater(message, interval=1)
+        await updater.progress([embed("drawing")])
+        await updater.finish([embed("done")], interactions.MISSING)
+        await asyncio.sleep(0.05)
+        return message.edits
+    assert asyncio.run(main()) == [("done", False)]
+
+
+def test_discard_ignores_further_progress():
+    async def main():
+        message = FakeMessage()
+        updater = MessageUpdater(message, interval=0)
+        await updater.progress([embed("drawing")])
+        await asyncio.sleep(0.05)
+        await updater.discard()
+        await updater.progress([embed("too late")])
+        await asyncio.sleep(0.05)
+        return message.edits
+    assert asyncio.run(main()) == [("drawing", False)]
+
+
+def test_finish_after_discard_is_dropped():
+    async def main():
+        message = FakeMessage()
+        updater = MessageUpdater(message, interval=0)
+        # The channel is busy, the final edit has to wait
+        updater._bucket.penalize(0.1)
+        finish = asyncio.ensure_future(updater.finish(
+            [embed("done")], interactions.MISSING, files=[]))
+        await asyncio.sleep(0.01)
+        # Deleted by its author meanwhile
+        await updater.discard()
+        await finish
+        return message.edits
+    assert asyncio.run(main()) == []
+
+
+def test_channel_bucket():
+    async def main():
+        bucket = ChannelBucket(burst=3, period=0.3)
+        started = time.monotonic()
+        times = []
+        for _ in range(5):
+            await bucket.acquire()
+            times.append(time.monotonic() - started)
+        return times
+    times = asyncio.run(main())
+    # A full bucket lets a burst through, then one edit per 0.1 seconds
+    assert times[2] < 0.05
+    assert 0.08 < times[3] < times[4]
+    assert 0.18 < times[4] < 1
+
+
+def test_channel_bucket_penalize():
+    async def main():
+        bucket = ChannelBucket(burst=3, period=0.3)
+        bucket.penalize(0.2)
+        started = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - started
+    assert 0.18 < asyncio.run(main()) < 1
+
+
+def test_messages_share_their_channel_bucket():
+    first, second = FakeMessage(), FakeMessage()
+    second.channel_id = first.channel_id
+    assert MessageUpdater(first)._bucket is MessageUpdater(second)._bucket
+    assert get_channel_bucket(first.channel_id) is not \
+        get_channel_bucket(FakeMessage().channel_id)
+
+
+class RefusingMessage(FakeMessage):
+    def __init__(self, code: int) -> None:
+        super().__init__()
+        self.code = code
+
+    async def edit(self, **kwargs) -> None:
+        raise interactions.LibraryException(code=self.code, message="refused")
+
+
+@pytest.mark.parametrize("code, penalized", [(429, True), (31001, True),
+                                             (50001, False), (10008, False)])
+def test_only_rate_limits_block_the_channel(code, penalized):
+    async def main():
+        updater = MessageUpdater(RefusingMessage(code), interval=1)
+        await updater.progress([embed("drawing")])
+        await asyncio.sleep(0.01)
+        return updater._bucket.blocked_until > time.monotonic()
+    assert asyncio.run(main()) == penalized
+
+
+def test_failed_final_upload_is_raised():
+    async def main():
+        updater = MessageUpdater(RefusingMessage(50001), interval=0)
+        # Without files there is nothing the caller could retry
+        await updater.finish([embed("done")], interactions.MISSING)
+        with pytest.raises(interactions.LibraryException):
+            await updater.finish([embed("done")], interactions.MISSING,
+                                 files=[])
+    asyncio.run(main())
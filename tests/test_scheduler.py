@@ -0,0 +1,211 @@
+import asyncio
+
+import elrond_scheduler
+from elrond_scheduler import Batcher, Scheduler
+
+
+def job(order: list, name: str, seconds: float = 0.01):
+    async def call():
+        await asyncio.sleep(seconds)
+        order.append(name)
+        return name
+    return call
+
+
+def test_round_robin_between_users():
+    async def main():
+        scheduler = Scheduler(1)
+        order = []
+        jobs = [scheduler.run("h", "a", job(order, name))
+                for name in ["a1", "a2", "a3"]]
+        jobs += [scheduler.run("h", "b", job(order, name))
+                 for name in ["b1", "b2"]]
+        jobs.append(scheduler.run("h", "c", job(order, "c1")))
+        assert await asyncio.gather(*jobs) == ["a1", "a2", "a3",
+                                               "b1", "b2", "c1"]
+        return order
+    assert asyncio.run(main()) == ["a1", "b1", "c1", "a2", "b2", "a3"]
+
+
+def test_positions():
+    async def main():
+        scheduler = Scheduler(1)
+        positions = {}
+
+        def on_position(name):
+            async def notify(position):
+                positions.setdefault(name, []).append(position)
+            return notify
+
+        order = []
+        jobs = [asyncio.ensure_future(scheduler.run(
+            "h", "a", job(order, name), on_position=on_position(name)))
+                for name in ["a1", "a2", "a3"]]
+        await asyncio.gather(*jobs)
+        await asyncio.sleep(0)
+        return positions
+    assert asyncio.run(main()) == {"a1": [0], "a2": [1, 0], "a3": [2, 1, 0]}
+
+
+def test_cancel_queued_job():
+    async def main():
+        scheduler = Scheduler(1)
+        order = []
+        first = asyncio.ensure_future(scheduler.run("h", "a", job(order, "a1")))
+        queued = asyncio.ensure_future(scheduler.run("h", "b", job(order, "b1")))
+        last = asyncio.ensure_future(scheduler.run("h", "c", job(order, "c1")))
+        await asyncio.sleep(0)
+        assert scheduler.queue_length("h") == 2
+        queued.cancel()
+        await asyncio.sleep(0)
+        assert scheduler.queue_length("h") == 1
+        await asyncio.gather(first, last)
+        return order
+    # The cancelled job never started
+    assert asyncio.run(main()) == ["a1", "c1"]
+
+
+def test_cancel_running_job():
+    async def main():
+        scheduler = Scheduler(1)
+        order = []
+        cancelled = asyncio.Event()
+
+        async def long_call():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        running = asyncio.ensure_future(scheduler.run("h", "a", long_call))
+        waiting = asyncio.ensure_future(scheduler.run("h", "b", job(order, "b1")))
+        await asyncio.sleep(0.01)
+        running.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        # The slot is free again for the next job
+        assert await asyncio.wait_for(waiting, 1) == "b1"
+    asyncio.run(main())
+
+
+def test_not_ready_backend_holds_jobs():
+    async def main():
+        scheduler = Scheduler(1)
+        scheduler.set_ready("h", False)
+        order = []
+        queued = asyncio.ensure_future(scheduler.run("h", "a", job(order, "a1")))
+        await asyncio.sleep(0.05)
+        assert order == [] and scheduler.queue_length("h") == 1
+        assert not scheduler.is_ready("h")
+        # No estimate while it's unknown when the backend is back
+        assert scheduler.expected_wait("h", 1) is None
+        scheduler.set_ready("h", True)
+        await queued
+        return order
+    assert asyncio.run(main()) == ["a1"]
+
+
+def test_priorities_and_aging():
+    async def main(aging):
+        scheduler = Scheduler(1, aging)
+        order = []
+        jobs = [scheduler.run("h", "x", job(order, "busy", 0.1)),
+                scheduler.run("h", "d", job(order, "draft"), priority=1),
+                scheduler.run("h", "u", job(order, "upscale"), priority=-1)]
+        jobs += [scheduler.run("h", "u" + str(i), job(order, "n" + str(i), 0.1))
+                 for i in range(4)]
+        await asyncio.gather(*jobs)
+        return order
+    assert asyncio.run(main(0)) == ["busy", "upscale", "n0", "n1", "n2",
+                                    "n3", "draft"]
+    # Once it waited long enough the draft takes its normal turn
+    assert asyncio.run(main(0.15)).index("draft") < 6
+
+
+def fake_txt2img(calls: list, release: asyncio.Event | None = None):
+    async def txt2img(prompt, seed, quantity=1, negative_prompt="",
+                      host=None, batch_size=1, queue=None, **options):
+        async def call():
+            calls.append((prompt, seed, batch_size))
+            if release is not None:
+                await release.wait()
+            return ["image" + str(seed + i) for i in range(batch_size)]
+        return await queue(call)
+    return txt2img
+
+
+def test_batch_member_leaves_before_flush(monkeypatch):
+    async def main():
+        calls = []
+        monkeypatch.setattr(elrond_scheduler, "interface_txt2img",
+                            fake_txt2img(calls))
+        batcher = Batcher(Scheduler(1), window=0.05, max_batch=4)
+        first = asyncio.ensure_future(batcher.txt2img("h", "a", "cat", 10))
+        leaving = asyncio.ensure_future(batcher.txt2img("h", "b", "cat", 20))
+        last = asyncio.ensure_future(batcher.txt2img("h", "c", "cat", 30))
+        await asyncio.sleep(0)
+        leaving.cancel()
+        results = await asyncio.gather(first, last)
+        return calls, results
+    calls, results = asyncio.run(main())
+    # Only the two remaining requests were drawn, with consecutive seeds
+    assert calls == [("cat", 10, 2)]
+    assert results == [(10, ["image10"]), (11, ["image11"])]
+
+
+def test_batch_member_leaves_after_flush(monkeypatch):
+    async def main():
+        calls = []
+        release = asyncio.Event()
+        monkeypatch.setattr(elrond_scheduler, "interface_txt2img",
+                            fake_txt2img(calls, release))
+        batcher = Batcher(Scheduler(1), window=0.01, max_batch=4)
+        staying = asyncio.ensure_future(batcher.txt2img("h", "a", "cat", 10))
+        leaving = asyncio.ensure_future(batcher.txt2img("h", "b", "cat", 20))
+        await asyncio.sleep(0.05)
+        assert calls == [("cat", 10, 2)]
+        leaving.cancel()
+        await asyncio.sleep(0)
+        # The batch keeps running for the one still waiting
+        release.set()
+        return calls, await staying
+    calls, result = asyncio.run(main())
+    assert calls == [("cat", 10, 2)]
+    assert result == (10, ["image10"])
+
+
+def test_batch_cancelled_when_everybody_left(monkeypatch):
+    async def main():
+        calls = []
+        monkeypatch.setattr(elrond_scheduler, "interface_txt2img",
+                            fake_txt2img(calls, asyncio.Event()))
+        scheduler = Scheduler(1)
+        batcher = Batcher(scheduler, window=0.01, max_batch=4)
+        requests = [asyncio.ensure_future(batcher.txt2img("h", user, "cat", 1))
+                    for user in ["a", "b"]]
+        await asyncio.sleep(0.05)
+        assert len(calls) == 1
+        for request in requests:
+            request.cancel()
+        await asyncio.sleep(0.01)
+        # The batch's job was cancelled and the backend is free again
+        order = []
+        assert await asyncio.wait_for(
+            scheduler.run("h", "c", job(order, "c1")), 1) == "c1"
+    asyncio.run(main())
+
+
+def test_batch_only_merges_same_prompt(monkeypatch):
+    async def main():
+        calls = []
+        monkeypatch.setattr(elrond_scheduler, "interface_txt2img",
+                            fake_txt2img(calls))
+        # A full batch goes out without waiting for the window
+        batcher = Batcher(Scheduler(1), window=10, max_batch=2)
+        requests = [batcher.txt2img("h", "a", "cat", 10),
+                    batcher.txt2img("h", "b", "cat", 20),
+                    batcher.txt2img("h", "c", "dog", 30),
+                    batcher.txt2img("h", "d", "dog", 40)]
+        await asyncio.wait_for(asyncio.gather(*requests), 1)
+        return calls
+    assert sorted(asyncio.run(main())) == [("cat", 10, 2), ("dog", 30, 2)]
@@ -0,0 +1,140 @@
+import asyncio
+import time
+
+import aiohttp
+import pytest
+
+import elrond_sd_interface
+from elrond_sd_interface import (BackendUnavailableError, BatchPlanner,
+                                 CircuitBreaker, OutOfMemoryError, retry)
+
+
+def test_batch_plan():
+    planner = BatchPlanner(4, {"http://small": 2})
+    assert planner.plan("http://big", 4) == (4, 1)
+    assert planner.plan("http://big", 6) == (3, 2)
+    # Image i keeps seed + i, so only divisors of the quantity are used
+    assert planner.plan("http://big", 7) == (1, 7)
+    assert planner.plan("http://big", 8, preferred=2) == (2, 4)
+    assert planner.plan("http://small", 4) == (2, 2)
+
+
+def test_batch_plan_record_oom():
+    planner = BatchPlanner(8, {})
+    planner.record_oom("http://h", 8)
+    assert planner.limit("http://h") == 7
+    # Never raised again, and never below 1
+    planner.record_oom("http://h", 8)
+    assert planner.limit("http://h") == 7
+    planner.record_oom("http://h", 1)
+    assert planner.limit("http://h") == 1
+
+
+def fake_post_for_images(requests: list, fits: int):
+    """Runs out of memory for batches larger than `fits`."""
+    async def post_for_images(host, endpoint, request, debug_file, *args,
+                              **kwargs):
+        requests.append((request["batch_size"], request["n_iter"]))
+        if request["batch_size"] > fits:
+            raise OutOfMemoryError("CUDA out of memory")
+        return ["image"] * (request["batch_size"] * request["n_iter"])
+    return post_for_images
+
+
+def test_generate_images_lowers_batch_size_on_oom(monkeypatch):
+    requests = []
+    planner = BatchPlanner(4, {})
+    monkeypatch.setattr(elrond_sd_interface, "batch_planner", planner)
+    monkeypatch.setattr(elrond_sd_interface, "post_for_images",
+                        fake_post_for_images(requests, fits=2))
+    images = asyncio.run(elrond_sd_interface.generate_images(
+        "http://h", "/sdapi/v1/txt2img", {"prompt": "cat"}, 4, None, ""))
+    assert len(images) == 4
+    assert requests == [(4, 1), (2, 2)]
+    # The next request starts with what fit
+    assert planner.plan("http://h", 4) == (2, 2)
+
+
+def test_generate_images_gives_up_without_batching(monkeypatch):
+    requests = []
+    monkeypatch.setattr(elrond_sd_interface, "batch_planner",
+                        BatchPlanner(2, {}))
+    monkeypatch.setattr(elrond_sd_interface, "post_for_images",
+                        fake_post_for_images(requests, fits=0))
+    images = asyncio.run(elrond_sd_interface.generate_images(
+        "http://h", "/sdapi/v1/txt2img", {"prompt": "cat"}, 2, None, ""))
+    assert images == []
+    assert requests == [(2, 1), (1, 2)]
+
+
+def fail(breaker: CircuitBreaker, host: str) -> None:
+    with pytest.raises(BackendUnavailableError):
+        with breaker.guard(host):
+            raise aiohttp.ClientConnectionError("refused")
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failures=2, cooldown=0.05)
+    fail(breaker, "h")
+    assert not breaker.is_open("h")
+    fail(breaker, "h")
+    assert breaker.is_open("h")
+    assert not breaker.is_open("other")
+    # Open: calls fail right away without running
+    with pytest.raises(BackendUnavailableError):
+        with breaker.guard("h"):
+            pytest.fail("called while open")
+
+    time.sleep(0.06)
+    # Half open: one more failure opens it for the next cooldown
+    fail(breaker, "h")
+    assert breaker.is_open("h")
+
+    time.sleep(0.06)
+    with breaker.guard("h"):
+        pass
+    # Closed again, it takes the full count to open it once more
+    fail(breaker, "h")
+    assert not breaker.is_open("h")
+
+
+def test_circuit_breaker_ignores_other_errors():
+    breaker = CircuitBreaker(failures=1, cooldown=10)
+    with pytest.raises(ValueError):
+        with breaker.guard("h"):
+            raise ValueError("not a network error")
+    assert not breaker.is_open("h")
+
+
+def flaky(failures: int, error: Exception):
+    """A call that fails `failures` times before it works."""
+    calls = []
+
+    async def call():
+        calls.append(1)
+        if len(calls) <= failures:
+            raise error
+        return "ok"
+    return call, calls
+
+
+def test_retry(monkeypatch):
+    monkeypatch.setattr(elrond_sd_interface, "retry_backoff", 0)
+    call, calls = flaky(2, aiohttp.ClientConnectionError("refused"))
+    assert asyncio.run(retry(call, attempts=3)) == "ok"
+    assert len(calls) == 3
+
+
+def test_retry_gives_up(monkeypatch):
+    monkeypatch.setattr(elrond_sd_interface, "retry_backoff", 0)
+    call, calls = flaky(3, asyncio.TimeoutError())
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(retry(call, attempts=3))
+    assert len(calls) == 3
+
+
+def test_retry_only_network_errors():
+    call, calls = flaky(1, ValueError("bad answer"))
+    with pytest.raises(ValueError):
+        asyncio.run(retry(call, attempts=3))
+    assert len(calls) == 1